@@ -12,6 +12,7 @@ setup(
     entry_points={
         'databroker.handlers': [
             "tes = sst_tes.handlers:SimpleHandler",
+            "tes_bin = sst_tes.handlers:BinaryHandler",
             "tessim = sst_tes.handlers:FakeHandler",
             ]
         },
@@ -0,0 +1,61 @@
+import threading
+import time as ttime
+from collections import deque
+from queue import Queue
+import numpy as np
+
+
+class AcquisitionWorker:
+    """
+    A long-lived thread that runs a device's acquisitions one after another, in the
+    order they were triggered, instead of a new thread per point.
+
+    Acquisitions report completion through the DeviceStatus they are given, and a
+    failed acquisition sets its exception on the status. The time from trigger to
+    the end of each acquisition is kept for the last `history` points.
+    """
+    def __init__(self, name, history=1000):
+        self.name = name
+        self.latencies = deque(maxlen=history)
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, acquire, status, *args):
+        """
+        Queue acquire(status, *args) and return status
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}_acquisition",
+                                                daemon=True)
+                self._thread.start()
+        self._queue.put((acquire, status, args, ttime.time()))
+        return status
+
+    @property
+    def queue_depth(self):
+        """
+        Acquisitions triggered but not yet finished, including the one running
+        """
+        return self._queue.unfinished_tasks
+
+    def stats(self):
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {"queue_depth": self.queue_depth, "points": 0}
+        return {"queue_depth": self.queue_depth, "points": len(latencies),
+                "last_latency": float(latencies[-1]), "mean_latency": float(latencies.mean()),
+                "max_latency": float(latencies.max())}
+
+    def _run(self):
+        while True:
+            acquire, status, args, t_queued = self._queue.get()
+            try:
+                acquire(status, *args)
+            except Exception as exc:
+                if not status.done:
+                    status.set_exception(exc)
+            finally:
+                self.latencies.append(ttime.time() - t_queued)
+                self._queue.task_done()
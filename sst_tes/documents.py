@@ -0,0 +1,53 @@
+"""
+Document stream helpers for runs with the TES devices
+"""
+from event_model import pack_datum_page, pack_event_page
+
+
+class DatumPager:
+    """
+    A RunEngine callback that passes the documents on to callback, with datums packed
+    into one datum_page per resource, e.g. RE.subscribe(DatumPager(db.insert)).
+
+    The RunEngine only takes single datums from devices, so each external ROI makes a
+    datum per point. Datums and events are held until batch_size events have arrived,
+    or until a document other than a resource or descriptor, and then sent as a
+    datum_page per resource followed by an event_page per descriptor, so that events
+    still follow the datums they reference. A lone event is sent as an event. Larger
+    batches mean fewer, bigger inserts, at the cost of consumers seeing each point later
+    """
+    def __init__(self, callback, batch_size=1):
+        self.callback = callback
+        self.batch_size = batch_size
+        self._datums = {}
+        self._events = {}
+        self._n_events = 0
+
+    def __call__(self, name, doc):
+        if name == "datum":
+            self._datums.setdefault(doc["resource"], []).append(doc)
+        elif name == "event":
+            self._events.setdefault(doc["descriptor"], []).append(doc)
+            self._n_events += 1
+            if self._n_events >= self.batch_size:
+                self.flush()
+        else:
+            # Held datums and events already follow their resource and descriptor
+            if name not in ("resource", "descriptor"):
+                self.flush()
+            self.callback(name, doc)
+
+    def flush(self):
+        """
+        Send everything held back
+        """
+        datums, self._datums = self._datums, {}
+        events, self._events = self._events, {}
+        self._n_events = 0
+        for resource_datums in datums.values():
+            self.callback("datum_page", pack_datum_page(*resource_datums))
+        for descriptor_events in events.values():
+            if len(descriptor_events) == 1:
+                self.callback("event", descriptor_events[0])
+            else:
+                self.callback("event_page", pack_event_page(*descriptor_events))
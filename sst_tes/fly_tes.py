@@ -8,10 +8,19 @@ from collections import OrderedDict
 import itertools
 import json
 from sst_tes.tes import TESBase
+from sst_tes.rpc import RPCException
 
 
 class FlyableTES(TESBase):
 
+    def __init__(self, name, *args, **kwargs):
+        super().__init__(name, *args, **kwargs)
+        # "poll" for one tfy event per collect, "push" to collect ROI counts pushed by the server,
+        # or "batch" to fetch every frame since the last collect in one call
+        self.collect_mode = "poll"
+        self._subscription = None
+        self._scan_ended = threading.Event()
+
     def _scan(self):
         # TES will send all data that hasn't been sent that
         # is probably current.
@@ -37,13 +46,66 @@ class FlyableTES(TESBase):
         if self.verbose:
             print("Exiting _scan thread")
 
+    def _receive(self):
+        # Turn every frame the server pushes into an event, stamped with the
+        # server's time for the frame
+        subscription = self._subscription
+        while not self._collection_status.done:
+            try:
+                msg = subscription.get(timeout=5)
+            except OSError:
+                if self.verbose:
+                    print("Subscription closed")
+                break
+            if msg is None:
+                if self.verbose:
+                    print("_receive timeout")
+                continue
+            frame = msg['data']
+            if 'scan_end' in frame:
+                self._scan_ended.set()
+                continue
+            event = dict()
+            event['time'] = frame['time']
+            event['data'] = {k: frame['counts'][k] for k in self.rois if k in frame['counts']}
+            event['timestamps'] = {k: frame['time'] for k in event['data']}
+            self._data.put(event)
+        if self.verbose:
+            print("Exiting _receive thread")
+
+    def _fetch_frames(self):
+        """
+        One event for every frame recorded since the last fetch, with the server's
+        timestamps and every configured ROI
+        """
+        new_frames = self._roi_cache.update()
+        if new_frames is None:
+            raise RPCException("The TES server cannot send frames incrementally, use another collect_mode")
+        start, stop = new_frames
+        keys = [k for k in self.rois if k in self._roi_cache.counts]
+        events = []
+        for i in range(start, stop):
+            t = self._roi_cache.time[i]
+            event = dict()
+            event['time'] = t
+            event['data'] = {k: self._roi_cache.counts[k][i] for k in keys}
+            event['timestamps'] = {k: t for k in keys}
+            events.append(event)
+        return events
+
     def kickoff(self):
+        self.point_times.reset()
         if self.file_mode == "start_stop":
             self._file_start()
 
         if self.state.get() == "no_file":
             self._file_start()
 
+        if self.collect_mode == "push":
+            # Subscribe before the scan starts so that no frame is missed
+            self._scan_ended.clear()
+            self._subscription = self.rpc.subscribe("roi_counts")
+
         if self.cal_flag.get():
             self._calibration_start()
         else:
@@ -57,11 +119,19 @@ class FlyableTES(TESBase):
         self._collection_status = DeviceStatus(device=self)
         self._data = Queue()
         self._instructions = Queue()
+        self._roi_cache.reset()
+        if self.collect_mode == "batch":
+            kickoff_st = DeviceStatus(device=self)
+            kickoff_st.set_finished()
+            return kickoff_st
 
         def flyer_worker():
             if self.verbose:
                 print("Started flyer worker")
-            self._scan()
+            if self.collect_mode == "push":
+                self._receive()
+            else:
+                self._scan()
         threading.Thread(target=flyer_worker, daemon=True).start()
         kickoff_st = DeviceStatus(device=self)
         kickoff_st.set_finished()
@@ -84,15 +154,31 @@ class FlyableTES(TESBase):
     def collect(self):
         if self.verbose:
             print("Collecting TES")
-        t = ttime.time()
-        self._instructions.put(t)
-        data = []
-        if self._completion_status.done:
-            if self.verbose:
-                print("Joining Queue")
-            self._instructions.join()
-            self._collection_status.set_finished()
+        if self.collect_mode == "push":
+            if self._completion_status.done and not self._collection_status.done:
+                # Every frame has arrived once the server has pushed the end of the scan
+                if not self._scan_ended.wait(timeout=5):
+                    print("Did not hear the end of the scan from TES, some frames may be missing")
+                self._collection_status.set_finished()
+                self._subscription.close()
+                self._subscription = None
+        elif self.collect_mode == "batch":
+            # Frames recorded before the scan ended are all on the server by now
+            final = self._completion_status.done
+            for e in self._fetch_frames():
+                self._data.put(e)
+            if final:
+                self._collection_status.set_finished()
+        else:
+            t = ttime.time()
+            self._instructions.put(t)
+            if self._completion_status.done:
+                if self.verbose:
+                    print("Joining Queue")
+                self._instructions.join()
+                self._collection_status.set_finished()
 
+        data = []
         while True:
             try:
                 e = self._data.get_nowait()
@@ -106,7 +192,11 @@ class FlyableTES(TESBase):
     def describe_collect(self):
         if self.verbose:
             print("Describe collect for flyable TES")
-        dd = OrderedDict({'tfy': {'source': 'TES_Detector', 'dtype': 'number', 'shape': []}})
+        if self.collect_mode in ("push", "batch"):
+            keys = self.rois
+        else:
+            keys = ['tfy']
+        dd = OrderedDict({k: {'source': 'TES_Detector', 'dtype': 'number', 'shape': []} for k in keys})
         return {self.name: dd}
 
 
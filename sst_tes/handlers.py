@@ -1,5 +1,21 @@
 import numpy as np
 import time
+import os
+import threading
+from collections import OrderedDict
+from .pfy_format import open_records
+
+def column_index(columns, label):
+    """
+    Index of the column(s) to read: one label, a list of labels (one per index, for
+    datum pages), or None for every column
+    """
+    if label is None:
+        return slice(None)
+    if isinstance(label, str):
+        return columns.index(label)
+    return np.array([columns.index(l) for l in label])
+
 
 class FakeHandler:
     def __init__(self, path, **resource_kwargs):
@@ -13,32 +29,249 @@ class FakeHandler:
         else:
             return index*np.ones(self.shape)
 
+class TextTable:
+    """
+    The parsed rows of a text PFY file. Only lines appended since the last refresh are
+    parsed, and the table starts over if the file is replaced or rewritten
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._reset()
+        self._stat = None
+
+    def _reset(self):
+        self.columns = None
+        self._table = None
+        self._nrows = 0
+        self._offset = 0
+        # The first and last lines parsed so far, and where the last one starts, which
+        # must read the same for the file to count as appended to
+        self._first_line = b""
+        self._last_line = b""
+        self._last_line_offset = 0
+
+    def _append_rows(self, rows):
+        n = self._nrows + len(rows)
+        if self._table is None or n > len(self._table):
+            # Grow geometrically so appending one row at a time stays cheap
+            table = np.empty((max(n, 2 * self._nrows, 16), rows.shape[1]), dtype=rows.dtype)
+            if self._table is not None:
+                table[:self._nrows] = self._table[:self._nrows]
+            self._table = table
+        self._table[self._nrows:n] = rows
+        self._nrows = n
+
+    def _appended(self, f, st):
+        """
+        True if the file only has bytes added after the ones already parsed
+        """
+        if self._stat is None or (st.st_dev, st.st_ino) != self._stat[:2]:
+            return False
+        if st.st_size < self._offset or (st.st_size == self._offset and st.st_mtime_ns != self._stat[3]):
+            return False
+        # A file rewritten in place, or recreated with a reused inode, can still be as
+        # big or bigger, so check that what was parsed is still there
+        f.seek(0)
+        if f.read(len(self._first_line)) != self._first_line:
+            return False
+        f.seek(self._last_line_offset)
+        return f.read(len(self._last_line)) == self._last_line
+
+    def refresh(self):
+        st = os.stat(self.path)
+        stat = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat == self._stat:
+            return
+        with open(self.path, "rb") as f:
+            if not self._appended(f, st):
+                self._reset()
+            self._stat = stat
+            if st.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            new = f.read(st.st_size - self._offset)
+        # Leave a partly written last line for the next call
+        end = new.rfind(b"\n") + 1
+        if end == 0:
+            return
+        raw_lines = new[:end].splitlines(keepends=True)
+        if self._offset == 0:
+            self._first_line = raw_lines[0]
+        self._last_line = raw_lines[-1]
+        self._last_line_offset = self._offset + end - len(self._last_line)
+        self._offset += end
+        lines = new[:end].decode().splitlines()
+        if self.columns is None and lines and lines[0].startswith("#"):
+            self.columns = lines[0][1:].split()
+        lines = [line for line in lines if line and not line.startswith("#")]
+        if lines:
+            self._append_rows(np.loadtxt(lines, ndmin=2))
+
+    @property
+    def nrows(self):
+        return self._nrows
+
+    @property
+    def nbytes(self):
+        return self._table.nbytes if self._table is not None else 0
+
+    @property
+    def rows(self):
+        return self._table[:self._nrows] if self._table is not None else np.empty((0, 0))
+
+
+class TableCache:
+    """
+    Process-wide store of TextTables by path, so that the handlers for each label of a
+    file share one parsed copy. Once the tables hold more than max_bytes, the least
+    recently used are dropped, and are parsed again if asked for later
+    """
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            table = self._tables.pop(path, None)
+            if table is None:
+                table = TextTable(path)
+            self._tables[path] = table
+            return table
+
+    def trim(self):
+        with self._lock:
+            total = sum(table.nbytes for table in self._tables.values())
+            # Never drop the most recently used table
+            while total > self.max_bytes and len(self._tables) > 1:
+                _, table = self._tables.popitem(last=False)
+                total -= table.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+
+text_table_cache = TableCache()
+
+
 class SimpleHandler:
+    """
+    Reads one labeled column of a text PFY file, or every column if there is no label.
+    A label in datum_kwargs takes the place of the resource's, so that the ROIs of one
+    device can share a resource. The parsed file is shared through text_table_cache
+    with the handlers for its other labels. Each call checks the file's identity, size
+    and mtime, and only the lines appended since it was last read are parsed, so each
+    datum costs O(1) once the file has been read. A replaced or rewritten file is
+    parsed again from the start.
+
+    index may also be a list, array or slice of indices, which are resolved together
+    into one array
+    """
+    table_cache = text_table_cache
+
     def __init__(self, path, **resource_kwargs):
         self.path = path
         self.shape = resource_kwargs.get("shape", [])
         self.label = resource_kwargs.get("label")
-        self.column = None
+
+    @property
+    def rows(self):
+        table = self.table_cache.get(self.path)
+        with table.lock:
+            table.refresh()
+            return table.rows
+
+    def __call__(self, *, index, **datum_kwargs):
+        table = self.table_cache.get(self.path)
+        with table.lock:
+            # Stat the file every time, since another handler's table may be for a file
+            # since replaced at the same path. This costs nothing more when it has not changed
+            table.refresh()
+            if isinstance(index, slice):
+                index = np.arange(table.nrows)[index]
+            nrows = table.nrows
+            if np.max(index, initial=-1) < nrows:
+                column = column_index(table.columns, datum_kwargs.get("label", self.label))
+                value = table.rows[index, column]
+        self.table_cache.trim()
+        if np.max(index, initial=-1) >= nrows:
+            # If the data is not there yet, need to raise IOError so that filler
+            # knows to wait and try again
+            print("Tried to get data and failed")
+            raise IOError(f"Index {np.max(index)} is beyond the {nrows} rows in {self.path}")
+        return value
+
+
+class BinaryHandler:
+    """
+    Reads one labeled column of a binary PFY file (see sst_tes.pfy_format), or every
+    column if there is no label, taking a label in datum_kwargs as SimpleHandler does.
+    Records have a fixed size, so any index is found without parsing the file. The file is
+    memory-mapped once per handler, and remapped only when a requested index is
+    beyond the records mapped so far.
+    index may be an int, or a list, array or slice of indices. Files with a record
+    shape, such as per-channel ROI counts, give an array of that shape per index,
+    read from one contiguous block of the record
+    """
+    # If True, array values are returned as read-only views into the map instead of
+    # copies. See MappedBinaryHandler
+    zero_copy = False
+
+    def __init__(self, path, **resource_kwargs):
+        self.path = path
+        self.shape = resource_kwargs.get("shape", [])
+        self.label = resource_kwargs.get("label")
+        self.columns = None
+        self._records = None
+        self._size = -1
+
+    def _remap(self):
+        size = os.path.getsize(self.path)
+        if size == self._size:
+            return
+        header, self._records = open_records(self.path)
+        self._size = size
+        self.columns = header["columns"]
 
     def __call__(self, *, index, **datum_kwargs):
-        if self.column is None:
-            with open(self.path) as f:
-                header = f.readline()
-            cols = header[1:-1].split()
-            self.column = cols.index(self.label)
-        data = np.loadtxt(self.path)
         try:
-            if len(data.shape) == 1:
-                return data[index]
-            else:
-                return data[index, self.column]
-        except IndexError as exc:
+            if isinstance(index, slice):
+                self._remap()
+            elif self._records is None or np.max(index, initial=-1) >= len(self._records):
+                self._remap()
+        except IOError:
+            print("Tried to get data and failed")
+            raise
+        if not isinstance(index, slice) and np.max(index, initial=-1) >= len(self._records):
             # If the data is not there yet, need to raise IOError so that filler
             # knows to wait and try again
             print("Tried to get data and failed")
-            raise IOError from exc
+            raise IOError(f"Index {np.max(index)} is beyond the {len(self._records)} records in {self.path}")
+        value = self._records[index, column_index(self.columns, datum_kwargs.get("label", self.label))]
+        if self.zero_copy or not np.ndim(value):
+            return value
+        return np.array(value)
 
-        return
+
+class MappedBinaryHandler(BinaryHandler):
+    """
+    BinaryHandler returning views into the shared memory map rather than copies, so
+    that many readers of one scan share the page cache instead of each holding a copy.
+    Register it for the tes_bin spec to use it, e.g.
+    db.reg.register_handler("tes_bin", MappedBinaryHandler, overwrite=True)
+    """
+    zero_copy = True
+
+
+def fill_datum_page(handler, datum_page):
+    """
+    Resolve every datum in a datum_page with a single handler call, for handlers
+    that accept an array of indices. Returns a dict of {datum_id: value}
+    """
+    values = handler(**datum_page["datum_kwargs"])
+    return dict(zip(datum_page["datum_id"], values))
 
 class SimpleHandler2:
     def __init__(self, path, **resource_kwargs):
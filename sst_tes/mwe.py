@@ -1,16 +1,20 @@
 from ophyd import DeviceStatus, Device, Component, Kind
 from ophyd.signal import AttributeSignal, Signal
 import time as ttime
-import threading
 from queue import Queue, Empty
 from collections import OrderedDict, deque
 import itertools
 from os.path import join, relpath
 from .tes_signals import *
-from .rpc import RPCInterface
+from .rpc import RPCInterface, RPCException
+from .acquisition import AcquisitionWorker
 from event_model import compose_resource
+from .pfy_format import SPECS
 
 class MWEROI(Device, RPCInterface):
+    # If True, make datums against the resource the parent composes for the PFY file,
+    # if it has one, rather than a resource of our own. See MWETES.shared_resource
+    shares_resource = True
 
     roi = Component(ExternalFileReference, shape=[], kind="normal")
     roi_lims = Component(RPCSignalPairAuto, method="roi", kind='config')
@@ -48,13 +52,18 @@ class MWEROI(Device, RPCInterface):
             return super().stage()
         else:
             self._data_index = itertools.count()
+            self._resource = None
+            self._datum_factory = self._shared_datum_factory()
+            if self._datum_factory is not None:
+                return super().stage()
             root, resource_path = self._get_resource_paths()
+            spec = self._get_resource_spec()
             # compose_resource currently needs start argument with placeholder uid, but
             # RunEngine replaces this uid with the real one for the run. In the future,
             # start argument to compose_resource will be optional
             self._resource, self._datum_factory, _ = compose_resource(
                 start={"uid": "temporary lie"},
-                spec="tes",
+                spec=spec,
                 root=root,
                 resource_path=resource_path,
                 resource_kwargs={"shape":self.roi.shape, "label": self.label},
@@ -74,10 +83,19 @@ class MWEROI(Device, RPCInterface):
             return
         else:
             i = next(self._data_index)
-            datum = self._datum_factory(datum_kwargs={"index": i})
+            if self._resource is None:
+                # The shared resource holds every ROI, so say which column is ours
+                datum = self._datum_factory(datum_kwargs={"index": i, "label": self.label})
+            else:
+                datum = self._datum_factory(datum_kwargs={"index": i})
             self._asset_docs_cache.append(("datum", datum))
             self.roi.put(datum["datum_id"])
             return
+
+    def _shared_datum_factory(self):
+        if not self.shares_resource:
+            return None
+        return getattr(self.parent, "_pfy_datum_factory", None)
         
     def collect_asset_docs(self):
         items = list(self._asset_docs_cache)
@@ -91,11 +109,101 @@ class MWEROI(Device, RPCInterface):
         resource_path = relpath(resource_full, start=root)
         return root, resource_path
 
+    def _get_resource_spec(self):
+        # Servers without a choice of output format write text
+        r = self.rpc.pfy_format()
+        return SPECS.get(r['response'], "tes") if r['success'] else "tes"
+
+class MWEROIChannels(MWEROI):
+    """
+    The counts of one ROI in each detector channel, as an (n_channels,) array per
+    point. The server writes these to a binary file of their own, with each ROI's
+    channels contiguous in every record
+    """
+    shares_resource = False
+
+    def stage(self):
+        if self.kind != Kind.omitted:
+            self.roi.shape = [self.rpc.n_channels()['response']]
+        return super().stage()
+
+    def _get_resource_paths(self):
+        root = self.rpc.base_user_output_dir()['response']
+        resource_full = self.rpc.get_channel_output_file()['response']
+        resource_path = relpath(resource_full, start=root)
+        return root, resource_path
+
+    def _get_resource_spec(self):
+        return SPECS["binary"]
+
+class MWESpectrum(Device, RPCInterface):
+    """
+    The energy spectrum of each point, histogrammed by the server with the bin edges
+    in bin_edges, and referenced by datum from the server's spectrum file
+    """
+    counts = Component(ExternalFileReference, shape=[], kind="normal")
+    bin_edges = Component(RPCSignalPairAuto, method="spectrum_bins", kind='config')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._asset_docs_cache = deque()
+        self._data_index = None
+
+    def set(self, edges):
+        self.bin_edges.put(list(edges))
+
+    def enable(self):
+        self.kind = Kind.normal
+
+    def disable(self):
+        self.kind = Kind.omitted
+
+    def stage(self):
+        if self.kind == Kind.omitted:
+            return super().stage()
+        self._data_index = itertools.count()
+        edges = self.bin_edges.get()
+        self.counts.shape = [len(edges) - 1]
+        root = self.rpc.base_user_output_dir()['response']
+        resource_full = self.rpc.get_spectrum_output_file()['response']
+        self._resource, self._datum_factory, _ = compose_resource(
+            start={"uid": "temporary lie"},
+            spec=SPECS["binary"],
+            root=root,
+            resource_path=relpath(resource_full, start=root),
+            resource_kwargs={"shape": self.counts.shape, "label": "spectrum", "bin_edges": edges},
+        )
+        self._resource.pop("run_start")
+        self._asset_docs_cache.append(("resource", self._resource))
+        return super().stage()
+
+    def unstage(self):
+        self._data_index = None
+        self._resource = None
+        self._datum_factory = None
+        return super().unstage()
+
+    def trigger(self):
+        if self.kind == Kind.omitted:
+            return
+        i = next(self._data_index)
+        datum = self._datum_factory(datum_kwargs={"index": i})
+        self._asset_docs_cache.append(("datum", datum))
+        self.counts.put(datum["datum_id"])
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        for item in items:
+            yield item
+
 class MWETES(Device, RPCInterface):
     _acquire_time = 1
     acquire_time = Component(AttributeSignal, '_acquire_time', kind=Kind.config)
     tfy = Component(MWEROI, "tfy", kind="normal")
     roi1 = Component(MWEROI, "roi1", kind="omitted")
+    tfy_channels = Component(MWEROIChannels, "tfy", kind="omitted")
+    spectrum = Component(MWESpectrum, "spectrum", kind="omitted")
     scan_num = Component(RPCSignal, method='scan_num', kind=Kind.config)
 
     def __init__(self, name, *args, verbose=False, **kwargs):
@@ -105,8 +213,21 @@ class MWETES(Device, RPCInterface):
         self._completion_status = None
         self._save_roi = False
         self.verbose = verbose
+        self.acquisition_worker = AcquisitionWorker(name)
+        self.acquire_mode = "client"  # Or "server", to have the server time each point
+        # If True, compose one resource for the PFY file at stage, which every enabled
+        # MWEROI makes its datums against, instead of a resource per ROI
+        self.shared_resource = True
+        self._asset_docs_cache = deque()
+        self._pfy_datum_factory = None
 
     def _acquire(self, status, i):
+        if self.acquire_mode == "server":
+            msg = self.rpc.scan_point_acquire(self.acquire_time.get(), i)
+            if not msg['success']:
+                raise RPCException(f"RPC failed with message {msg['response']}")
+            status.set_finished()
+            return
         ttime.sleep(self.acquire_time.get())
         self.rpc.roi_save_counts()
         status.set_finished()
@@ -119,8 +240,28 @@ class MWETES(Device, RPCInterface):
         self._external_devices = [dev for _, dev in self._get_components_of_kind(Kind.normal)
                                   if hasattr(dev, 'collect_asset_docs')]
         self.rpc.scan_start()
+        if self.shared_resource and any(getattr(dev, 'shares_resource', False)
+                                        for dev in self._external_devices):
+            self._stage_pfy_resource()
 
         return super().stage()
+
+    def _stage_pfy_resource(self):
+        """
+        Compose the resource for the PFY file, fetching its location in one round trip
+        """
+        root, resource_full, pfy_format = self.rpc.call_many(
+            ["base_user_output_dir", "get_pfy_output_file", "pfy_format"])
+        spec = SPECS.get(pfy_format['response'], "tes") if pfy_format['success'] else "tes"
+        resource, self._pfy_datum_factory, _ = compose_resource(
+            start={"uid": "temporary lie"},
+            spec=spec,
+            root=root['response'],
+            resource_path=relpath(resource_full['response'], start=root['response']),
+            resource_kwargs={"shape": []},
+        )
+        resource.pop("run_start")
+        self._asset_docs_cache.append(("resource", resource))
     
     def unstage(self):
         if self.verbose: print("Complete acquisition of TES")
@@ -128,6 +269,7 @@ class MWETES(Device, RPCInterface):
         self._log = {}
         self._data_index = None
         self._external_devices = None
+        self._pfy_datum_factory = None
         return super().unstage()
         
     def trigger(self):
@@ -137,10 +279,13 @@ class MWETES(Device, RPCInterface):
 
         status = DeviceStatus(self)
         i = next(self._data_index)
-        threading.Thread(target=self._acquire, args=(status, i), daemon=True).start()
+        self.acquisition_worker.submit(self._acquire, status, i)
         return status
 
     def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
         for dev in self._external_devices:
             yield from dev.collect_asset_docs()
             
@@ -8,7 +8,15 @@ from inspect import signature
 import collections
 import textwrap
 import shutil
+import threading
+import functools
+import contextlib
 import numpy as np
+from sst_tes.wire import (is_framed, frame, send_frame, recv_frame, recv_unframed,
+                          json_default, has_arrays, encode_binary, BINARY_ENCODING)
+import queue
+from sst_tes.pfy_format import RecordWriter
+from sst_tes.timing import LatencyStats
 
 
 def time_human(t=None):
@@ -52,24 +60,61 @@ def call_method_from_data(data, dispatch, no_traceback_error_types):
 def make_simple_response(_id, method_name, args, kwargs, result, error):
     if error is not None:
         #response = f"Error: {error}"
-        response = json.dumps({"response": error, "success": False})
+        response = json.dumps({"response": error, "success": False, "id": _id})
     else:
         #response = f"{result}"
-        response = json.dumps({"response": result, "success": True})
+        response = json.dumps({"response": result, "success": True, "id": _id}, default=json_default)
     return response
 
+def make_binary_response(_id, method_name, args, kwargs, result, error):
+    """
+    Encode the response as NPBUF if the result holds arrays, otherwise as JSON
+    """
+    if error is None and has_arrays(result):
+        return encode_binary({"response": result, "success": True, "id": _id})
+    return make_simple_response(_id, method_name, args, kwargs, result, error).encode()
+
+def accepts_binary(data):
+    """
+    True if the request asked for NPBUF responses with "accept": ["npbuf"]
+    """
+    if b'"accept"' not in data:
+        return False
+    try:
+        return BINARY_ENCODING in json.loads(data).get("accept", [])
+    except Exception:
+        return False
+
+UNFRAMED_STALL_TIMEOUT = 2.0
+
 def get_message(sock):
+    """
+    Read one complete message, returning (msg, framed), or (None, None) if the
+    client went away. Framed and legacy bare-JSON clients are both accepted, and
+    framed tells the caller how to send the reply
+    """
     try:
-        msg = sock.recv(2**12)
-        if msg == b'':
-            return None
+        first = sock.recv(1, socket.MSG_PEEK)
+        if first == b'':
+            return None, None
+        framed = is_framed(first)
+        if framed:
+            msg = recv_frame(sock)
         else:
-            return msg
-    except ConnectionResetError:
-        return None
+            # A legacy message that stops arriving part way is answered with a parse
+            # error rather than holding the connection
+            msg = recv_unframed(sock, stall_timeout=UNFRAMED_STALL_TIMEOUT)
+        return msg, framed
+    except (ConnectionError, ValueError):
+        return None, None
 
-def handle_one_message(sock, data, dispatch, verbose, no_traceback_error_types):
+def handle_one_message(sock, data, dispatch, verbose, no_traceback_error_types, framed=False,
+                       latency=None):
+    """
+    latency: a LatencyStats to record the dispatch, encode and send time of the call in
+    """
     # following https://gist.github.com/limingzju/6483619
+    t0 = time.perf_counter()
     t_s = time.time()
     t_struct = time.localtime(t_s)
     t_human = time_human(t_struct)
@@ -77,17 +122,28 @@ def handle_one_message(sock, data, dispatch, verbose, no_traceback_error_types):
         print(f"{t_human}")
         print(f"got: {data}")
     _id, method_name, args, kwargs, result, error = call_method_from_data(data, dispatch, no_traceback_error_types)
+    t1 = time.perf_counter()
     # if verbose:
     #     print(f"id: {_id}, method_name: {method_name}, args: {args}, result: {result}, error: {error}")
-    response = make_simple_response(_id, method_name, args, kwargs, result, error).encode()
+    if framed and accepts_binary(data):
+        # Only framed replies can carry binary payloads
+        response = make_binary_response(_id, method_name, args, kwargs, result, error)
+    else:
+        response = make_simple_response(_id, method_name, args, kwargs, result, error).encode()
+    t2 = time.perf_counter()
     if verbose:
         print(f"responded: {response}")
     try:
-        n = sock.send(response)
-        assert n == len(response), f"only {n} of {len(response)} bytes were sent"
+        if framed:
+            send_frame(sock, response)
+        else:
+            sock.sendall(response)
     except BrokenPipeError:
         print("failed to send response")
         pass
+    if latency is not None:
+        latency.record(str(method_name), dispatch=t1 - t0, encode=t2 - t1,
+                       send=time.perf_counter() - t2)
     return t_human, data, response
 
 def make_attribute_accessor(x, a):
@@ -109,9 +165,270 @@ def get_dispatch_from(x):
                 d[m] = getattr(x, m)
             else:
                 d[m] = make_attribute_accessor(x, m)
+    d["multicall"] = make_multicall(d)
     return d
 
-def start(address, port, dispatch, verbose, log_file, no_traceback_error_types):
+def make_multicall(dispatch):
+    def multicall(calls):
+        """
+        calls: a list of [method, args, kwargs], args and kwargs optional
+        returns a list of {"response": ..., "success": ...}, one per call
+        """
+        results = []
+        for call in calls:
+            method_name, args, kwargs = (list(call) + [[], {}])[:3]
+            if method_name not in dispatch:
+                results.append({"response": f"Method '{method_name}' does not exit", "success": False})
+                continue
+            try:
+                results.append({"response": dispatch[method_name](*args, **kwargs), "success": True})
+            except Exception as e:
+                results.append({"response": f"Calling Exception: method={method_name}: {e}",
+                                "success": False})
+        return results
+
+    return multicall
+
+_dispatch_context = threading.local()
+
+def unserialized(method):
+    """
+    Mark a server method to be called outside the concurrent server's dispatch lock,
+    so that a call that mostly waits does not hold up other clients. The method must
+    use serialized() around anything that touches the server object's state
+    """
+    method.unserialized = True
+    return method
+
+@contextlib.contextmanager
+def serialized():
+    """
+    Inside an unserialized method, hold the dispatch lock of the concurrent server
+    that called it. Does nothing otherwise, as calls are then one at a time anyway
+    """
+    dispatch_queue = getattr(_dispatch_context, "queue", None)
+    if dispatch_queue is None:
+        yield
+    else:
+        with dispatch_queue._dispatch_lock:
+            yield
+
+class DispatchQueue:
+    """
+    Serializes calls into the server object for the concurrent server, and keeps
+    track of how many requests are waiting for their turn
+    """
+    def __init__(self, max_clients):
+        self._dispatch_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._client_slots = threading.BoundedSemaphore(max_clients)
+        self.depth = 0
+        self.max_depth = 0
+        self.handled = 0
+        self.clients = 0
+        self.waiting_clients = 0
+
+    def wrap(self, method):
+        unlocked = getattr(method, "unserialized", False)
+
+        @functools.wraps(method)
+        def serialized(*args, **kwargs):
+            with self._count_lock:
+                self.depth += 1
+                self.max_depth = max(self.max_depth, self.depth)
+            try:
+                if unlocked:
+                    _dispatch_context.queue = self
+                    try:
+                        return method(*args, **kwargs)
+                    finally:
+                        _dispatch_context.queue = None
+                with self._dispatch_lock:
+                    return method(*args, **kwargs)
+            finally:
+                with self._count_lock:
+                    self.depth -= 1
+                    self.handled += 1
+        return serialized
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+        Hold one of the max_clients connection slots while serving a client
+        """
+        with self._count_lock:
+            self.waiting_clients += 1
+        with self._client_slots:
+            with self._count_lock:
+                self.waiting_clients -= 1
+                self.clients += 1
+            try:
+                yield
+            finally:
+                with self._count_lock:
+                    self.clients -= 1
+
+    def stats(self):
+        """
+        queue_depth counts requests in or waiting for dispatch, waiting_clients counts
+        connections accepted but not yet served because max_clients are connected
+        """
+        with self._count_lock:
+            return {"queue_depth": self.depth, "max_queue_depth": self.max_depth,
+                    "handled": self.handled, "clients": self.clients,
+                    "waiting_clients": self.waiting_clients}
+
+def serialize_dispatch(dispatch, dispatch_queue):
+    d = collections.OrderedDict()
+    for k, m in dispatch.items():
+        d[k] = dispatch_queue.wrap(m)
+    # answered without waiting behind other requests
+    d["server_stats"] = dispatch_queue.stats
+    return d
+
+class Publisher:
+    """
+    Pushes messages on named topics to clients that subscribed to them. A client
+    subscribes by sending a framed {"method": "subscribe", "params": [topic]} request
+    on a connection of its own, which then receives a framed
+    {"topic": ..., "data": ..., "time": ...} message for each publish.
+    publish only queues the message, and a thread per subscriber sends it, so a slow
+    subscriber does not hold up the server. Subscribers that fall more than
+    max_backlog messages behind are disconnected
+    """
+    def __init__(self, max_backlog=10000):
+        self.max_backlog = max_backlog
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, sock, topic, response):
+        """
+        Send the response acknowledging the subscription, then start pushing topic to sock
+        """
+        with self._lock:
+            if sock not in self._subscribers:
+                outbox = queue.Queue(self.max_backlog)
+                outbox.put(response)
+                self._subscribers[sock] = (set(), outbox)
+                threading.Thread(target=self._send_loop, args=(sock, outbox), daemon=True).start()
+                full = False
+            else:
+                full = not _put_nowait(self._subscribers[sock][1], response)
+            self._subscribers[sock][0].add(topic)
+        if full:
+            self._drop(sock)
+
+    def unsubscribe(self, sock):
+        """
+        Stop pushing to sock. Never blocks, so a stuck subscriber cannot hold up the caller
+        """
+        with self._lock:
+            topics, outbox = self._subscribers.pop(sock, (None, None))
+        if outbox is not None and not _put_nowait(outbox, None):
+            # The sender has a full outbox to get through first, so cut the connection
+            # instead, and its next send fails
+            _shutdown(sock)
+
+    def publish(self, topic, data):
+        msg = frame(json.dumps({"topic": topic, "data": data, "time": time.time()},
+                               default=json_default).encode())
+        with self._lock:
+            outboxes = [(sock, outbox) for sock, (topics, outbox) in self._subscribers.items()
+                        if topic in topics]
+        for sock, outbox in outboxes:
+            if not _put_nowait(outbox, msg):
+                self._drop(sock)
+
+    def _drop(self, sock):
+        """
+        Disconnect a subscriber that fell max_backlog messages behind
+        """
+        print(f"subscriber {_peer_name(sock)} fell behind, dropping it")
+        self.unsubscribe(sock)
+        _shutdown(sock)
+
+    def _send_loop(self, sock, outbox):
+        while True:
+            msg = outbox.get()
+            if msg is None:
+                return
+            try:
+                sock.sendall(msg)
+            except OSError:
+                self.unsubscribe(sock)
+                return
+
+def _put_nowait(outbox, msg):
+    """
+    Queue msg, returning False instead of waiting if outbox is full
+    """
+    try:
+        outbox.put_nowait(msg)
+        return True
+    except queue.Full:
+        return False
+
+def _shutdown(sock):
+    """
+    Shut sock down, so that reads see the end of the connection and sends fail,
+    whatever state the peer is in
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def _peer_name(sock):
+    try:
+        return sock.getpeername()
+    except OSError:
+        return "(disconnected)"
+
+def get_subscription(data):
+    """
+    The topic and id of a subscribe request, or (None, None) for any other message
+    """
+    if b'"subscribe"' not in data:
+        return None, None
+    try:
+        d = json.loads(data)
+        if d.get("method") != "subscribe":
+            return None, None
+        return d.get("params", [None])[0], d.get("id", -1)
+    except (ValueError, AttributeError, IndexError):
+        return None, None
+
+def serve_client(clientsocket, dispatch, verbose, log_file, no_traceback_error_types, log_lock=None,
+                 publisher=None, latency=None):
+    while True:
+        data, framed = get_message(clientsocket)
+        if data is None:
+            print(f"data was none, breaking to wait for connection")
+            if publisher is not None:
+                publisher.unsubscribe(clientsocket)
+            clientsocket.close()
+            break
+        if publisher is not None:
+            topic, _id = get_subscription(data)
+            if topic is not None:
+                if framed:
+                    response = make_simple_response(_id, "subscribe", [topic], {}, topic, None)
+                    publisher.subscribe(clientsocket, topic, frame(response.encode()))
+                else:
+                    response = make_simple_response(_id, "subscribe", [topic], {}, None,
+                                                    "Subscriptions need a framed connection")
+                    clientsocket.sendall(response.encode())
+                continue
+        a = handle_one_message(clientsocket, data, dispatch, verbose, no_traceback_error_types,
+                               framed=framed, latency=latency)
+        t_human, data, response = a
+        if log_file is not None:
+            with log_lock or contextlib.nullcontext():
+                log_file.write(f"{t_human}")
+                log_file.write(f"{data}\n")
+                log_file.write(f"{response}\n")
+
+def print_methods(address, port, dispatch, log_file):
     terminal_size = shutil.get_terminal_size((80, 20)) 
     print(f"TES Scan Server @ {address}:{port}")
     print("Ctrl-C to exit")
@@ -123,43 +440,143 @@ def start(address, port, dispatch, verbose, log_file, no_traceback_error_types):
             initial_indent="* ", subsequent_indent="\t" )
         for l in wrapped:
             print(l)
+
+def make_server_socket(address, port, backlog):
     serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # bind the socket to a public host, and a well-known port
     serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     serversocket.bind((address, port))
     # become a server socket
-    serversocket.listen(1)
+    serversocket.listen(backlog)
+    return serversocket
+
+def accept_client(serversocket):
+    """
+    Accept the next connection, returning (clientsocket, address). Nagle's algorithm is
+    turned off, since pipelined responses go out back to back and would otherwise wait
+    on the client's delayed ACK
+    """
+    (clientsocket, address) = serversocket.accept()
+    clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return clientsocket, address
+
+def add_latency_stats(dispatch, log_interval=None):
+    """
+    Make a LatencyStats for the server's calls, and add a latency_stats method reporting it
+    """
+    latency = LatencyStats("server", log_interval=log_interval)
+    dispatch = collections.OrderedDict(dispatch)
+    dispatch["latency_stats"] = latency.stats
+    return dispatch, latency
+
+def start(address, port, dispatch, verbose, log_file, no_traceback_error_types, latency_log_interval=None):
+    dispatch, latency = add_latency_stats(dispatch, latency_log_interval)
+    print_methods(address, port, dispatch, log_file)
+    serversocket = make_server_socket(address, port, 1)
     if log_file is not None:
         log_file.write(f"{dispatch}\n")
     try:
         while True:
             # accept connections from outside
-            (clientsocket, address) = serversocket.accept()
+            (clientsocket, address) = accept_client(serversocket)
             print(f"connection from {address}")
-            while True:
-                data = get_message(clientsocket)
-                if data is None:
-                    print(f"data was none, breaking to wait for connection")
-                    break
-                a = handle_one_message(clientsocket, data, dispatch, verbose, no_traceback_error_types)  
-                t_human, data, response = a
-                if log_file is not None:
-                    log_file.write(f"{t_human}")
-                    log_file.write(f"{data}\n")
-                    log_file.write(f"{response}\n")
+            serve_client(clientsocket, dispatch, verbose, log_file, no_traceback_error_types,
+                         latency=latency)
     except KeyboardInterrupt:
         print("\nCtrl-C detected, shutting down")
         if log_file is not None:
             log_file.write(f"Ctrl-C at {time_human()}\n")
         return
 
+def start_concurrent(address, port, dispatch, verbose, log_file, no_traceback_error_types,
+                     max_clients=16, publisher=None, latency_log_interval=None):
+    """
+    Like start, but serves up to max_clients connections at once, each on its own
+    thread. Calls into dispatch are still made one at a time, so the server object
+    does not need to be thread safe, except for methods marked unserialized. Adds a server_stats method reporting queue depth.
+    If a Publisher is given, clients may subscribe to the topics published on it.
+    Dispatch times include any wait for another client's call to finish
+    """
+    dispatch_queue = DispatchQueue(max_clients)
+    dispatch = serialize_dispatch(dispatch, dispatch_queue)
+    dispatch, latency = add_latency_stats(dispatch, latency_log_interval)
+    print_methods(address, port, dispatch, log_file)
+    serversocket = make_server_socket(address, port, max_clients)
+    if log_file is not None:
+        log_file.write(f"{dispatch}\n")
+    log_lock = threading.Lock()
+
+    def client_worker(clientsocket, address):
+        with dispatch_queue.client():
+            serve_client(clientsocket, dispatch, verbose, log_file, no_traceback_error_types,
+                         log_lock=log_lock, publisher=publisher, latency=latency)
+        print(f"connection from {address} closed")
+
+    try:
+        while True:
+            (clientsocket, address) = accept_client(serversocket)
+            print(f"connection from {address}")
+            threading.Thread(target=client_worker, args=(clientsocket, address), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nCtrl-C detected, shutting down")
+        serversocket.close()
+        if log_file is not None:
+            with log_lock:
+                log_file.write(f"Ctrl-C at {time_human()}\n")
+        return
+
 class TESSim:
     
-    def __init__(self, base_user_output_dir="/tmp"):
+    # Longest stretch of photons simulated for one frame, so that a frame saved long
+    # after the last one stays a sensible size
+    max_frame_time = 10
+    # Written to the output files for an ROI removed part way through a scan
+    missing_counts = -1
+
+    def __init__(self, base_user_output_dir="/tmp", pfy_format="text", publisher=None, n_channels=16,
+                 photon_rate=1e5, flush_rows=100, flush_interval=0.5):
+        """
+        pfy_format: "text" for whitespace separated rows, or "binary" for fixed-size
+            records as described in sst_tes.pfy_format
+        publisher: a Publisher to push the ROI counts of each completed frame to,
+            on the "roi_counts" topic
+        n_channels: number of simulated detector channels. The counts of each ROI can
+            also be saved per channel, to a binary file of (n_channels,) records. 0 for none
+        photon_rate: photons per second over the whole detector. Each frame is made of the
+            photons arriving since the previous frame, with energies from a few emission
+            lines over a flat background, each landing in a random channel
+        flush_rows, flush_interval: output rows are buffered and written once this many
+            are waiting or the oldest has waited this many seconds, see RecordWriter.
+            flush_output writes them right away
+
+        Each frame can also save an energy spectrum, histogrammed with the bin edges set
+        by spectrum_bins_set, to a binary file of its own.
+        The spectrum and channel files cost a histogram per frame, so they are only made
+        once a client asks where one is, with get_spectrum_output_file or
+        get_channel_output_file, as the devices reading them do when staged, or for
+        channel counts with roi_get_channel_counts. A request lasts until the scan ends
+        """
         self.base_user_output_dir = base_user_output_dir
+        self.pfy_format = pfy_format
+        self.n_channels = n_channels
+        self.photon_rate = photon_rate
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
         self.scan_num = 1
         self.state = "file_open"
         self._roi = {"tfy": (200, 1600)}
+        self._publisher = publisher
+        self._frame_index = 0
+        self._frames = []
+        self._channel_counts = {}
+        self._spectrum_edges = np.linspace(0, 2000, 401)
+        self._writers = {}
+        self._outputs_wanted = set()
+        self._frame_start = time.time()
+
+    def _publish(self, topic, data):
+        if self._publisher is not None:
+            self._publisher.publish(topic, data)
         
     def roi_get(self, key=None):
         if key is None:
@@ -189,44 +606,209 @@ class TESSim:
             self._roi.update(roi_dict)
             return
 
+    def _simulate_photons(self, duration):
+        """
+        Energies in eV and channels of the photons of one frame, sorted by energy
+        """
+        n = np.random.poisson(self.photon_rate * min(duration, self.max_frame_time))
+        lines = np.array([285, 400, 530, 710, 850])
+        n_line = np.random.binomial(n, 0.8)
+        energies = np.concatenate([np.random.normal(np.random.choice(lines, n_line), 2.0),
+                                   np.random.uniform(0, 2000, n - n_line)])
+        channels = np.random.randint(0, max(self.n_channels, 1), n)
+        order = np.argsort(energies)
+        return energies[order], channels[order]
+
+    def _writer(self, path, fmt):
+        if path not in self._writers:
+            self._writers[path] = RecordWriter(path, fmt, flush_rows=self.flush_rows,
+                                               flush_interval=self.flush_interval)
+        return self._writers[path]
+
+    def _close_writers(self):
+        writers, self._writers = self._writers, {}
+        for writer in writers.values():
+            writer.close()
+
     def roi_save_counts(self):
-        roi_counts = {}
-        for name, (lo_ev, hi_ev) in self._roi.items():
-            counts = np.random.random()*(hi_ev - lo_ev) + lo_ev
-            roi_counts[name] = int(counts)
-        output_file = self.get_pfy_output_file(make=True)
-        roi_names = roi_counts.keys()
-        data = np.array([roi_counts[name] for name in roi_names])
-        header = " ".join(roi_names)
-        if not os.path.isfile(output_file):
-            print("ROI Save Counts", header)
-            with open(output_file, "w") as f:
-                np.savetxt(f, data[np.newaxis, :], header=header)
-        else:
-            with open(output_file, "a") as f:
-                np.savetxt(f, data[np.newaxis, :])
-        return roi_counts        
+        """
+        Make a frame of the photons since the last one, save it, and return its ROI
+        counts. The frame is written out before it is recorded or published, so a
+        frame that cannot be written is not seen by anyone.
+
+        Each scan's ROI and channel files keep the ROIs they started with, so that row i
+        is still frame i after a roi_set during the scan: a removed ROI is written as
+        missing_counts, and an added one is left out of the files, though it is still
+        returned, recorded and published. A frame saved while no ROIs are set is
+        missing_counts throughout, or not written if the files have not been started
+        """
+        t = time.time()
+        energies, channels = self._simulate_photons(t - self._frame_start)
+        roi_names = list(self._roi)
+        # One pass over the sorted energies finds the photons of every ROI at once;
+        # ROI i holds photons bounds[i, 0] up to bounds[i, 1], as its range is [lo, hi)
+        lims = np.array([self._roi[name] for name in roi_names], dtype=float).reshape(-1, 2)
+        bounds = np.searchsorted(energies, lims)
+        data = bounds[:, 1] - bounds[:, 0]
+        roi_counts = dict(zip(roi_names, data.tolist()))
+        channels_wanted = self.n_channels > 0 and "channels" in self._outputs_wanted
+        if channels_wanted:
+            channel_counts = np.array([np.bincount(channels[lo:hi], minlength=self.n_channels)
+                                       for lo, hi in bounds]).reshape(-1, self.n_channels)
+        if "spectrum" in self._outputs_wanted:
+            spectrum = np.diff(np.searchsorted(energies, self._spectrum_edges))
+            self._writer(self._spectrum_path(), "binary").append(["spectrum"], spectrum[np.newaxis])
+        outputs = [(self._writer(self.get_pfy_output_file(), self.pfy_format), data)]
+        if channels_wanted:
+            outputs.append((self._writer(self._channel_path(), "binary"), channel_counts))
+        for writer, rows in outputs:
+            # A file is not started with no columns at all
+            if roi_names or writer.columns is not None:
+                writer.append(roi_names, rows, fill=self.missing_counts)
+        self._frame_start = t
+        if channels_wanted:
+            self._channel_counts = dict(zip(roi_names, channel_counts))
+        self._frames.append((t, roi_counts))
+        self._publish("roi_counts", {"index": self._frame_index, "time": t, "counts": roi_counts})
+        self._frame_index += 1
+        return roi_counts
+
+    def flush_output(self):
+        """
+        Write out every buffered output row now
+        """
+        for writer in list(self._writers.values()):
+            writer.flush()
+
+    def spectrum_bins_get(self):
+        return self._spectrum_edges.tolist()
+
+    def spectrum_bins_set(self, edges):
+        """
+        edges: increasing spectrum bin edges in eV. Cannot change during a scan, since
+        every spectrum of a scan is in one file
+        """
+        if self.state == "scan":
+            raise ValueError("Cannot change the spectrum bins during a scan")
+        edges = np.asarray(edges, dtype=float)
+        if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) <= 0):
+            raise ValueError(f"Spectrum bin edges must increase, got {edges}")
+        self._spectrum_edges = edges
+
+    def roi_get_channel_counts(self):
+        """
+        The per-channel ROI counts of the latest frame, as {name: array of n_channels}.
+        Channel counts are only made once asked for, so the first call of a scan gives
+        zeros, and later ones the counts of frames since
+        """
+        self._outputs_wanted.add("channels")
+        return {name: self._channel_counts.get(name, np.zeros(self.n_channels, dtype=int))
+                for name in self._roi}
+
+    def roi_get_counts(self):
+        """
+        The ROI counts of the latest frame
+        """
+        if len(self._frames) == 0:
+            return {name: 0 for name in self._roi}
+        return self._frames[-1][1]
+
+    def roi_get_counts_since(self, cursor=0):
+        """
+        The ROI counts of every frame of the current (or last) scan from index cursor on,
+        as {"start": cursor, "cursor": next cursor, "time": [t, ...],
+        "counts": {name: [counts, ...]}}. A cursor beyond the end of the scan is taken
+        to be from an earlier scan, and start is then 0.
+        Counts are None for frames saved before an ROI was added
+        """
+        if cursor > len(self._frames):
+            # The client's cursor is from an earlier scan, start it over
+            cursor = 0
+        frames = self._frames[cursor:]
+        names = list(self._roi)
+        for _, roi_counts in frames:
+            names.extend(name for name in roi_counts if name not in names)
+        return {"start": cursor, "cursor": cursor + len(frames),
+                "time": [t for t, _ in frames],
+                "counts": {name: [roi_counts.get(name) for _, roi_counts in frames] for name in names}}
+
+    @unserialized
+    def scan_point_acquire(self, duration, var_val=None):
+        """
+        Acquire one scan point for duration seconds, timed by the server's clock, then
+        save its ROI counts. Replies only once the point is complete, so the client
+        needs no timer of its own.
+        Other clients of the concurrent server are served while the point is acquired
+        """
+        with serialized():
+            start = time.time()
+            self._frame_start = start
+        time.sleep(duration)
+        with serialized():
+            end = time.time()
+            counts = self.roi_save_counts()
+        return {"start": start, "end": end, "var_val": var_val, "counts": counts}
     
-    def scan_start(self):
+    def scan_start(self, var_name=None, var_unit=None, sample_id=None, sample_name=None, extra=None):
+        # Takes the scan description that TESBase sends the real server, and ignores it
+        self._close_writers()
         self.state = "scan"
+        self._frame_index = 0
+        self._frames = []
+        self._channel_counts = {}
+        self._outputs_wanted = set()
+        self._frame_start = time.time()
         
-    def scan_end(self):
+    def scan_end(self, _try_post_processing=False):
+        self._close_writers()
+        self._outputs_wanted = set()
         self.state = "file_open"
+        self._publish("roi_counts", {"scan_end": self.scan_num, "frames": self._frame_index})
         self.scan_num += 1
 
     def get_pfy_output_file(self, make=False):
-        filename = join(self.base_user_output_dir, "pfy_test", f"scan{self.scan_num}")
+        suffix = ".bin" if self.pfy_format == "binary" else ""
+        filename = join(self.base_user_output_dir, "pfy_test", f"scan{self.scan_num}{suffix}")
         directory = dirname(filename)
         if make:
             Path(directory).mkdir(parents=True, exist_ok=True)
             
         return filename
 
+    def _spectrum_path(self):
+        return join(self.base_user_output_dir, "pfy_test", f"scan{self.scan_num}_spectrum.bin")
+
+    def _channel_path(self):
+        return join(self.base_user_output_dir, "pfy_test", f"scan{self.scan_num}_channels.bin")
+
+    def get_spectrum_output_file(self, make=False):
+        """
+        The file of per-frame spectra, which is always binary. Asking for it has each
+        frame from now until the end of the scan write its spectrum there
+        """
+        self._outputs_wanted.add("spectrum")
+        filename = self._spectrum_path()
+        if make:
+            Path(dirname(filename)).mkdir(parents=True, exist_ok=True)
+        return filename
+
+    def get_channel_output_file(self, make=False):
+        """
+        The file of per-channel ROI counts, which is always binary. Asking for it has
+        each frame from now until the end of the scan write its channel counts there
+        """
+        self._outputs_wanted.add("channels")
+        filename = self._channel_path()
+        if make:
+            Path(dirname(filename)).mkdir(parents=True, exist_ok=True)
+        return filename
+
 
 if __name__ == "__main__":
     address = "localhost"
     port = 4000
 
-    tesserver = TESSim()
+    publisher = Publisher()
+    tesserver = TESSim(publisher=publisher)
     dispatch = get_dispatch_from(tesserver)
-    start(address, port, dispatch, True, None, [])
+    start_concurrent(address, port, dispatch, True, None, [], publisher=publisher)
@@ -0,0 +1,170 @@
+"""
+Binary PFY files: fixed-size records after a small self-describing header.
+
+The file starts with MAGIC, a 4 byte little-endian header length, and a JSON
+header {"columns": [...], "dtype": "<i8", "shape": []}, padded with spaces so that
+records start on a HEADER_ALIGN byte boundary. Each record then holds one value of
+the given dtype and shape per column, in column order, so record i starts at
+data_offset + i*record_size and the whole file can be memory-mapped as an array of
+shape (n_records, n_columns, *shape).
+
+Text PFY files are whitespace separated rows under a "# column names" line.
+"""
+import json
+import os
+import struct
+import threading
+import numpy as np
+
+MAGIC = b"TESPFY\x01\x00"
+HEADER_LENGTH = struct.Struct("<I")
+HEADER_ALIGN = 64
+
+# databroker handler spec for each output format of the TES server
+SPECS = {"text": "tes", "binary": "tes_bin"}
+
+
+def make_header(columns, dtype, shape=()):
+    header = json.dumps({"columns": list(columns), "dtype": np.dtype(dtype).str,
+                         "shape": list(shape)}).encode()
+    prefix = len(MAGIC) + HEADER_LENGTH.size
+    padded = -(-(prefix + len(header)) // HEADER_ALIGN) * HEADER_ALIGN - prefix
+    return MAGIC + HEADER_LENGTH.pack(padded) + header.ljust(padded)
+
+
+def read_header(f):
+    """
+    Read the header from an open binary file, returning (header dict, data offset)
+    """
+    f.seek(0)
+    prefix = f.read(len(MAGIC) + HEADER_LENGTH.size)
+    if len(prefix) < len(MAGIC) + HEADER_LENGTH.size:
+        raise IOError(f"{getattr(f, 'name', f)} has no complete header yet")
+    if prefix[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', f)} is not a binary PFY file")
+    (n,) = HEADER_LENGTH.unpack(prefix[len(MAGIC):])
+    raw = f.read(n)
+    if len(raw) < n:
+        raise IOError(f"{getattr(f, 'name', f)} has no complete header yet")
+    return json.loads(raw.decode()), len(prefix) + n
+
+
+def record_shape(header):
+    return (len(header["columns"]), *header["shape"])
+
+
+def record_size(header):
+    return int(np.prod(record_shape(header))) * np.dtype(header["dtype"]).itemsize
+
+
+def open_records(path):
+    """
+    Memory-map the complete records of a binary PFY file, returning (header, array)
+    with array shape (n_records, n_columns, *shape)
+    """
+    with open(path, "rb") as f:
+        header, offset = read_header(f)
+    n = (os.path.getsize(path) - offset) // record_size(header)
+    shape = (n, *record_shape(header))
+    if n == 0:
+        return header, np.empty(shape, dtype=header["dtype"])
+    return header, np.memmap(path, dtype=header["dtype"], mode="r", offset=offset, shape=shape)
+
+
+class RecordWriter:
+    """
+    Appends rows to a text or binary PFY file through one file kept open until close().
+    Rows are buffered and written together: once flush_rows rows are waiting, once the
+    oldest has waited flush_interval seconds, and on flush() and close(). The file is
+    opened, and its directory made, when the first row arrives. An existing file is
+    appended to, after checking that a binary file's columns and shape match
+    """
+    def __init__(self, path, fmt="text", flush_rows=100, flush_interval=0.5):
+        self.path = path
+        self.fmt = fmt
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.columns = None
+        self._shape = None
+        self._dtype = None
+        self._f = None
+        self._rows = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _open(self, columns, row):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        exists = os.path.isfile(self.path)
+        if self.fmt == "binary":
+            if exists:
+                with open(self.path, "rb") as f:
+                    header, _ = read_header(f)
+                if header["columns"] != list(columns) or tuple(header["shape"]) != row.shape[1:]:
+                    raise ValueError(f"Records with columns {list(columns)} and shape {row.shape[1:]} do not "
+                                     f"match {self.path}, which has {header['columns']} and {header['shape']}")
+                self._dtype = np.dtype(header["dtype"])
+            self._f = open(self.path, "ab")
+            if not exists:
+                self._dtype = row.dtype
+                self._f.write(make_header(columns, row.dtype, row.shape[1:]))
+        else:
+            self._f = open(self.path, "a")
+            if not exists:
+                self._f.write("# " + " ".join(columns) + "\n")
+        self.columns = list(columns)
+        self._shape = row.shape[1:]
+
+    def append(self, columns, row, fill=None):
+        """
+        Queue one row. row has shape (n_columns, *shape), and text rows must be flat.
+
+        fill: if given, a row whose columns differ from the file's is fitted to them,
+            with this value in the file's columns the row lacks, and the row's columns
+            the file lacks left out. Otherwise such a row raises ValueError
+        """
+        row = np.asarray(row)
+        with self._lock:
+            if self._f is None:
+                self._open(columns, row)
+            elif fill is not None and list(columns) != self.columns and row.shape[1:] == self._shape:
+                index = {name: i for i, name in enumerate(columns)}
+                fitted = np.full((len(self.columns), *self._shape), fill, dtype=row.dtype)
+                for i, name in enumerate(self.columns):
+                    if name in index:
+                        fitted[i] = row[index[name]]
+                row = fitted
+            elif list(columns) != self.columns or row.shape[1:] != self._shape:
+                raise ValueError(f"Row with columns {list(columns)} and shape {row.shape[1:]} does not "
+                                 f"match {self.path}, which has {self.columns} and {list(self._shape)}")
+            self._rows.append(row)
+            if len(self._rows) >= self.flush_rows:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows or self._f is None:
+            return
+        data = np.stack(self._rows)
+        self._rows = []
+        if self.fmt == "binary":
+            self._f.write(data.astype(self._dtype, copy=False).tobytes())
+        else:
+            np.savetxt(self._f, data)
+        self._f.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
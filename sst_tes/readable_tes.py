@@ -1,14 +1,15 @@
 from ophyd import DeviceStatus, Device, Component, Kind
 from ophyd.signal import AttributeSignal, Signal
 import time as ttime
-import threading
 from queue import Queue, Empty
 from collections import OrderedDict, deque
 import itertools
 from os.path import join, relpath
 from .tes_signals import *
 from .rpc import RPCInterface
+from .acquisition import AcquisitionWorker
 from event_model import compose_resource
+from .pfy_format import SPECS
 from .tes import TESBase
 
 class TESROIBase(Device, RPCInterface):
@@ -54,12 +55,13 @@ class TESROIext(TESROIBase):
         else:
             self._data_index = itertools.count()
             root, resource_path = self._get_resource_paths()
+            spec = self._get_resource_spec()
             # compose_resource currently needs start argument with placeholder uid, but
             # RunEngine replaces this uid with the real one for the run. In the future,
             # start argument to compose_resource will be optional
             self._resource, self._datum_factory, _ = compose_resource(
                 start={"uid": "temporary lie"},
-                spec="tes",
+                spec=spec,
                 root=root,
                 resource_path=resource_path,
                 resource_kwargs={"shape":self.roi.shape, "label": self.label},
@@ -96,16 +98,26 @@ class TESROIext(TESROIBase):
         resource_path = relpath(resource_full, start=root)
         return root, resource_path
 
+    def _get_resource_spec(self):
+        # Servers without a choice of output format write text
+        r = self.rpc.pfy_format()
+        return SPECS.get(r['response'], "tes") if r['success'] else "tes"
+
 
 class TES(TESBase):
     def read(self):
         d = super().read()
         if self.write_off:
-            rois = self.rpc.roi_get_counts()['response']
+            if self._roi_cache.update() is not None and self._roi_cache.time:
+                rois = self._roi_cache.latest()
+            else:
+                rois = self.rpc.roi_get_counts()['response']
             for k in self.rois:
                 key = self.name + "_" + k
                 val = rois[k]
                 d[key] = {"value": val, "timestamp": self.last_time}
+            if self.point_times.last_index is not None:
+                self.point_times.mark(self.point_times.last_index, "roi_read")
         return d
 
     def stage(self):
@@ -115,6 +127,7 @@ class TES(TESBase):
         self._completion_status = DeviceStatus(self)
         self._external_devices = [dev for _, dev in self._get_components_of_kind(Kind.normal)
                                   if hasattr(dev, 'collect_asset_docs')]
+        self._roi_cache.reset()
 
         if self.file_mode == "start_stop":
             self._file_start()
@@ -131,7 +144,9 @@ class TES(TESBase):
         return super().stage()
 
     def unstage(self):
-        if self.verbose: print("Complete acquisition of TES")
+        if self.verbose:
+            print("Complete acquisition of TES")
+            print("Point timing:", self.timing_summary())
         self._scan_end()
         if self.file_mode == "start_stop":
             self._file_end()
@@ -169,6 +184,7 @@ class OLDTES(Device, RPCInterface):
         self._completion_status = None
         self._save_roi = False
         self.verbose = verbose
+        self.acquisition_worker = AcquisitionWorker(name)
         self.file_mode = "continuous" # Or "continuous"
         self.write_ljh = True
         self.write_off = True
@@ -282,7 +298,7 @@ class OLDTES(Device, RPCInterface):
 
         status = DeviceStatus(self)
         i = next(self._data_index)
-        threading.Thread(target=self._acquire, args=(status, i), daemon=True).start()
+        self.acquisition_worker.submit(self._acquire, status, i)
         return status
         
     def start_log(self, doc_name, document):
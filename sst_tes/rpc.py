@@ -1,17 +1,59 @@
 from ophyd.ophydobj import OphydObject
 import json
 import socket
+import threading
+import asyncio
+import itertools
+import time as ttime
+from .timing import LatencyStats
+from .wire import (frame, send_frame, recv_frame, recv_unframed, read_frame, read_unframed,
+                   decode_payload, BINARY_ENCODING)
 
 
 class RPCException(Exception):
     pass
 
 
+class _RequestNotSent(OSError):
+    """
+    Sending a request failed, so the server cannot have run it and it is safe to retry
+    """
+
+
+def _send(s, data):
+    try:
+        s.sendall(data)
+    except socket.timeout:
+        raise
+    except OSError as exc:
+        raise _RequestNotSent(*exc.args) from exc
+
+
+def _is_open(s):
+    """
+    False if the server has closed an idle connection. Nothing should be waiting to be
+    read on an idle connection, so unexpected data also makes it unusable
+    """
+    timeout = s.gettimeout()
+    try:
+        s.setblocking(False)
+        s.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        s.settimeout(timeout)
+
+
 class RPCInterface(OphydObject):
-    def __init__(self, *args, address="", port=None, **kwargs):
+    def __init__(self, *args, address="", port=None, pooled=False, max_connections=1,
+                 framed=False, binary=False, **kwargs):
         super().__init__(*args, **kwargs)
         if port is not None:
-            self.rpc = JSONClient(address, port)
+            self.rpc = JSONClient(address, port, pooled=pooled, max_connections=max_connections,
+                                  framed=framed, binary=binary)
         else:
             self.rpc = self._get_comm_function()
 
@@ -36,29 +78,471 @@ class RPCInterface(OphydObject):
             raise IOError("No parent has an RPC Client")
 
 
+def normalize_call(call):
+    """
+    Expand a (method, args, kwargs) call, where args and kwargs are optional
+    """
+    if isinstance(call, str):
+        call = (call,)
+    method, args, kwargs = (tuple(call) + ((), {}))[:3]
+    return method, list(args), dict(kwargs)
+
+
+def is_missing_method(response, method):
+    """
+    True if response is the server's reply to a call of a method it does not have,
+    as opposed to a call that failed. The TES server, and the sim after it, reply
+    "Method '<method>' does not exit, valid methods are [...]"
+    """
+    if response['success']:
+        return False
+    return str(response['response']).startswith((f"Method '{method}' does not exit",
+                                                 f"Method '{method}' does not exist"))
+
+
+def check_response_id(response, _id):
+    # Servers that predate request ids do not echo them back
+    if response.get("id", _id) != _id:
+        raise RPCException(f"Got response to request {response['id']} while waiting for {_id}")
+
+
 class JSONClient:
-    def __init__(self, address, port):
+    def __init__(self, address, port, pooled=False, max_connections=1, timeout=None, framed=False,
+                 binary=False):
+        """
+        address, port: location of the TES RPC server
+        pooled: if True, keep connections open between calls and reuse them,
+            instead of connecting once per call
+        max_connections: maximum number of simultaneous pooled connections. Callers
+            beyond this wait for a free connection, so the default of 1 serializes all
+            threads over one socket, which a single-client server can handle
+        timeout: socket timeout in seconds, None to block
+        framed: if True, send and expect length-prefixed messages (see sst_tes.wire).
+            Otherwise send bare JSON, which servers without framing support understand
+        binary: if True, ask the server to send results holding NumPy arrays in the
+            binary NPBUF encoding, which decodes to arrays rather than lists. Needs framed;
+            servers that do not know the encoding keep answering in JSON
+
+        The time each call spends connecting, sending, waiting for the response and
+        decoding it is recorded by method in self.latency, see stats()
+        """
         self.address = address
         self.port = port
+        self.pooled = pooled
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.framed = framed
+        self.binary = binary
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._async_client = None
+        self._ids = itertools.count()
+        self._has_multicall = None
+        self.latency = LatencyStats(f"RPC {address}:{port}")
 
-    def formatMsg(self, method, *params, **kwargs):
-        msg = {"method": method}
+    def makeMsg(self, method, *params, **kwargs):
+        msg = {"method": method, "id": next(self._ids)}
         if params is not None and params != []:
             msg["params"] = params
         if kwargs is not None and kwargs != {}:
             msg["kwargs"] = kwargs
-        return json.dumps(msg).encode()
+        if self.binary and self.framed:
+            msg["accept"] = [BINARY_ENCODING]
+        return msg
+
+    def formatMsg(self, method, *params, **kwargs):
+        return json.dumps(self.makeMsg(method, *params, **kwargs)).encode()
+
+    def _connect(self, timings=None):
+        t0 = ttime.perf_counter()
+        # An empty address means the local host, as it does for socket.connect
+        s = socket.create_connection((self.address or None, self.port), timeout=self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if timings is not None:
+            timings["connect"] += ttime.perf_counter() - t0
+        return s
+
+    def _exchange(self, s, msg, timings=None):
+        t0 = ttime.perf_counter()
+        data = json.dumps(msg).encode()
+        if self.framed:
+            _send(s, frame(data))
+            t1 = ttime.perf_counter()
+            data = recv_frame(s)
+        else:
+            _send(s, data)
+            t1 = ttime.perf_counter()
+            data = recv_unframed(s)
+        t2 = ttime.perf_counter()
+        response = decode_payload(data)
+        check_response_id(response, msg["id"])
+        if timings is not None:
+            timings.update(send=t1 - t0, wait=t2 - t1, decode=ttime.perf_counter() - t2)
+        return response
+
+    def _exchange_many(self, s, msgs):
+        _send(s, b"".join(frame(json.dumps(msg).encode()) for msg in msgs))
+        responses = {}
+        for _ in msgs:
+            response = decode_payload(recv_frame(s))
+            responses[response.get("id")] = response
+        try:
+            return [responses[msg["id"]] for msg in msgs]
+        except KeyError as exc:
+            raise RPCException(f"No response to request id {exc}") from exc
+
+    def _call(self, exchange, timings=None):
+        """
+        Run exchange(socket) on a pooled connection if pooled, otherwise on a fresh one
+        """
+        if not self.pooled:
+            s = self._connect(timings)
+            try:
+                return exchange(s)
+            finally:
+                s.close()
+        with self._slots:
+            s = self._pop_idle()
+            if s is not None:
+                try:
+                    m = exchange(s)
+                except _RequestNotSent:
+                    # The server dropped the idle connection before the request reached
+                    # it; retry once on a fresh one. Failures after sending are not
+                    # retried, since the server may already have run the request
+                    s.close()
+                    s = None
+                except BaseException:
+                    s.close()
+                    raise
+            if s is None:
+                s = self._connect(timings)
+                try:
+                    m = exchange(s)
+                except BaseException:
+                    s.close()
+                    raise
+            with self._idle_lock:
+                self._idle.append(s)
+            return m
+
+    def _pop_idle(self):
+        """
+        An idle pooled connection that the server has not closed, or None
+        """
+        while True:
+            with self._idle_lock:
+                if not self._idle:
+                    return None
+                s = self._idle.pop()
+            if _is_open(s):
+                return s
+            s.close()
 
     def sendrcv(self, method, *params, **kwargs):
-        msg = self.formatMsg(method, *params, **kwargs)
-        s = socket.socket()
-        s.connect((self.address, self.port))
-        s.send(msg)
-        m = json.loads(s.recv(1024).decode())
-        s.close()
-        return m
+        msg = self.makeMsg(method, *params, **kwargs)
+        timings = {"connect": 0.0}
+        t0 = ttime.perf_counter()
+        response = self._call(lambda s: self._exchange(s, msg, timings), timings)
+        self.latency.record(method, total=ttime.perf_counter() - t0, **timings)
+        return response
+
+    def stats(self):
+        """
+        Latency of the calls made so far by method, see LatencyStats.stats
+        """
+        return self.latency.stats()
+
+    def pipeline(self, calls):
+        """
+        Send several requests before reading any response, and match the responses
+        to the requests by id. calls is a list of (method, args, kwargs) tuples, where
+        args and kwargs may be left off. Returns the responses in the order of calls.
+        Needs a framed connection; unframed clients make the calls one at a time
+        """
+        calls = [normalize_call(call) for call in calls]
+        if not self.framed:
+            return [self.sendrcv(method, *args, **kwargs) for method, args, kwargs in calls]
+        msgs = [self.makeMsg(method, *args, **kwargs) for method, args, kwargs in calls]
+        timings = {"connect": 0.0}
+        t0 = ttime.perf_counter()
+        responses = self._call(lambda s: self._exchange_many(s, msgs), timings)
+        self.latency.record("pipeline", total=ttime.perf_counter() - t0, **timings)
+        return responses
+
+    def call_many(self, calls):
+        """
+        Make several calls in a single request with the server's multicall method.
+        Takes and returns the same as pipeline, which is used instead against servers
+        without multicall, and for this call if multicall fails
+        """
+        calls = [normalize_call(call) for call in calls]
+        if self._has_multicall is not False:
+            r = self.sendrcv("multicall", calls)
+            if r['success']:
+                self._has_multicall = True
+                return r['response']
+            # Any other failure is retried with multicall next time
+            if is_missing_method(r, "multicall"):
+                self._has_multicall = False
+        return self.pipeline(calls)
+
+    def close(self):
+        """
+        Close all idle pooled connections
+        """
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for s in idle:
+            s.close()
+
+    def subscribe(self, topic):
+        """
+        Open a Subscription to the messages the server pushes on topic
+        """
+        return Subscription(self.address, self.port, topic, self.makeMsg("subscribe", topic),
+                            timeout=self.timeout)
+
+    def asyncio_client(self):
+        """
+        An AsyncJSONClient for the same server, created on first use and shared by
+        everything holding this client
+        """
+        if self._async_client is None:
+            self._async_client = AsyncJSONClient(self.address, self.port, framed=self.framed,
+                                                 timeout=self.timeout, binary=self.binary)
+        return self._async_client
 
     def __getattr__(self, attr):
         def _method(*params, **kwargs):
             return self.sendrcv(attr, *params, **kwargs)
         return _method
+
+
+class Subscription:
+    """
+    A connection of its own on which the server pushes the messages published on one
+    topic, each a dict with "topic", "data" and "time" keys
+    """
+    def __init__(self, address, port, topic, msg, timeout=None):
+        self.topic = topic
+        self._sock = socket.create_connection((address or None, port), timeout=timeout)
+        try:
+            send_frame(self._sock, json.dumps(msg).encode())
+            response = json.loads(recv_frame(self._sock).decode())
+        except BaseException:
+            self._sock.close()
+            raise
+        if not response['success']:
+            self._sock.close()
+            raise RPCException(f"Subscribing to {topic} failed with message {response['response']}")
+
+    def get(self, timeout=None):
+        """
+        The next pushed message, waiting up to timeout seconds (forever if None).
+        Returns None on timeout, and raises ConnectionError once the server has gone
+        """
+        self._sock.settimeout(timeout)
+        try:
+            # Wait for the start of a message, but never time out part way through one
+            if not self._sock.recv(1, socket.MSG_PEEK):
+                raise ConnectionError(f"Subscription to {self.topic} closed by the server")
+        except socket.timeout:
+            return None
+        self._sock.settimeout(None)
+        return json.loads(recv_frame(self._sock).decode())
+
+    def close(self):
+        self._sock.close()
+
+
+class AsyncJSONClient:
+    def __init__(self, address, port, framed=False, timeout=None, binary=False):
+        """
+        asyncio counterpart of JSONClient, with server methods available as coroutines,
+        i.e. `await client.scan_num()`. One connection is kept open. If framed, calls
+        are pipelined on it: every call is sent right away and responses are matched
+        to their requests by id as they arrive. Otherwise calls take turns.
+        The connection belongs to the event loop it was opened in, and is reopened if
+        the client is used from a different loop
+        """
+        self.address = address
+        self.port = port
+        self.framed = framed
+        self.binary = binary
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._has_multicall = None
+        self._loop = None
+        self._lock = None
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._receiver = None
+
+    makeMsg = JSONClient.makeMsg
+    formatMsg = JSONClient.formatMsg
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._reader = None
+            self._writer = None
+            self._pending = {}
+            self._receiver = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.address or None, self.port)
+        if self.framed:
+            self._receiver = asyncio.ensure_future(self._receive(self._reader))
+
+    def _disconnect(self, exc=None):
+        if self._writer is not None:
+            self._writer.close()
+        if self._receiver is not None and self._receiver is not asyncio.current_task():
+            self._receiver.cancel()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("RPC connection closed"))
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+
+    async def _receive(self, reader):
+        """
+        Hand each response on a pipelined connection to the call waiting for its id
+        """
+        try:
+            while True:
+                response = decode_payload(await read_frame(reader))
+                future = self._pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except (OSError, asyncio.IncompleteReadError, ValueError) as exc:
+            if reader is self._reader:
+                self._disconnect(ConnectionError(f"RPC connection lost: {exc!r}"))
+
+    def _idle_closed(self):
+        # The server closing an idle connection feeds EOF to the reader even though
+        # nothing is reading it
+        return self._reader.at_eof() or self._writer.is_closing()
+
+    async def _exchange(self, msg):
+        try:
+            self._writer.write(json.dumps(msg).encode())
+            await self._writer.drain()
+        except OSError as exc:
+            raise _RequestNotSent(*exc.args) from exc
+        response = decode_payload(await read_unframed(self._reader))
+        check_response_id(response, msg["id"])
+        return response
+
+    async def _sendrcv_serial(self, msg):
+        async with self._lock:
+            if self._writer is not None and self._idle_closed():
+                self._disconnect()
+            reused = self._writer is not None
+            if not reused:
+                await self._connect()
+            try:
+                return await asyncio.wait_for(self._exchange(msg), self.timeout)
+            except _RequestNotSent:
+                self._disconnect()
+                if not reused:
+                    raise
+            except BaseException:
+                # Including failures after sending, which are not retried since the
+                # server may already have run the request
+                self._disconnect()
+                raise
+            # The server dropped the idle connection before the request reached it;
+            # retry once on a fresh one
+            await self._connect()
+            try:
+                return await asyncio.wait_for(self._exchange(msg), self.timeout)
+            except BaseException:
+                self._disconnect()
+                raise
+
+    async def _send_pipelined(self, msg):
+        """
+        Returns (future for the response, whether a send on a reused connection failed)
+        """
+        async with self._lock:
+            if self._writer is not None and self._idle_closed():
+                self._disconnect()
+            reused = self._writer is not None
+            if not reused:
+                await self._connect()
+            future = self._loop.create_future()
+            self._pending[msg["id"]] = future
+            writer = self._writer
+            try:
+                writer.write(frame(json.dumps(msg).encode()))
+                await writer.drain()
+            except OSError as exc:
+                self._disconnect(ConnectionError(f"RPC connection lost: {exc!r}"))
+                return future, reused
+        return future, False
+
+    async def _sendrcv_pipelined(self, msg):
+        future, retry = await self._send_pipelined(msg)
+        if not retry:
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            finally:
+                self._pending.pop(msg["id"], None)
+        # The server dropped the idle connection before the request reached it; retry
+        # once on a fresh one. Failures after sending are not retried, since the server
+        # may already have run the request
+        future, _ = await self._send_pipelined(msg)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(msg["id"], None)
+
+    async def sendrcv(self, method, *params, **kwargs):
+        msg = self.makeMsg(method, *params, **kwargs)
+        self._bind_loop()
+        if self.framed:
+            return await self._sendrcv_pipelined(msg)
+        return await self._sendrcv_serial(msg)
+
+    async def pipeline(self, calls):
+        """
+        Make several calls at once, see JSONClient.pipeline
+        """
+        calls = [normalize_call(call) for call in calls]
+        return list(await asyncio.gather(*[self.sendrcv(method, *args, **kwargs)
+                                           for method, args, kwargs in calls]))
+
+    async def call_many(self, calls):
+        """
+        Make several calls in a single request, see JSONClient.call_many
+        """
+        calls = [normalize_call(call) for call in calls]
+        if self._has_multicall is not False:
+            r = await self.sendrcv("multicall", calls)
+            if r['success']:
+                self._has_multicall = True
+                return r['response']
+            if is_missing_method(r, "multicall"):
+                self._has_multicall = False
+        return await self.pipeline(calls)
+
+    async def close(self):
+        if self._writer is not None:
+            writer = self._writer
+            self._disconnect()
+            await writer.wait_closed()
+
+    def __getattr__(self, attr):
+        async def _method(*params, **kwargs):
+            return await self.sendrcv(attr, *params, **kwargs)
+        return _method
@@ -1,13 +1,14 @@
 from ophyd import DeviceStatus, Device, Component, Kind
 from ophyd.signal import AttributeSignal, Signal
 import time as ttime
-import threading
 from queue import Queue, Empty
 from collections import OrderedDict, deque
 import itertools
 from os.path import join, relpath
 from .tes_signals import *
-from .rpc import RPCInterface, RPCException
+from .rpc import RPCInterface, RPCException, is_missing_method
+from .acquisition import AcquisitionWorker
+from .timing import PointTimes
 from functools import wraps
 
 
@@ -19,6 +20,52 @@ def raiseOnFailure(f):
             raise RPCException(f"RPC failed with message {response['response']}")
 
 
+class ROICache:
+    """
+    A client-side copy of the ROI counts of every frame of a scan, kept up to date by
+    fetching only the frames recorded since the last update
+    """
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.supported = True
+        self.reset()
+
+    def reset(self):
+        self.cursor = 0
+        self.time = []
+        self.counts = {}
+
+    def update(self):
+        """
+        Fetch new frames from the server, returning the (start, stop) range of frames
+        that were added, or None if the server cannot send frames incrementally.
+        Raises RPCException if the call fails for any other reason
+        """
+        if not self.supported:
+            return None
+        r = self.rpc.roi_get_counts_since(self.cursor)
+        if not r['success']:
+            if is_missing_method(r, "roi_get_counts_since"):
+                self.supported = False
+                return None
+            raise RPCException(f"RPC failed with message {r['response']}")
+        frames = r['response']
+        if frames['start'] < self.cursor:
+            # The server started a new scan
+            self.reset()
+        n_before = len(self.time)
+        self.time.extend(frames['time'])
+        for name, values in frames['counts'].items():
+            self.counts.setdefault(name, [None]*n_before).extend(values)
+        for values in self.counts.values():
+            values.extend([None]*(len(self.time) - len(values)))
+        self.cursor = frames['cursor']
+        return frames['start'], self.cursor
+
+    def latest(self):
+        return {name: values[-1] for name, values in self.counts.items() if values}
+
+
 class TESBase(Device, RPCInterface):
     _cal_flag = False
     _acquire_time = 1
@@ -27,11 +74,20 @@ class TESBase(Device, RPCInterface):
     acquire_time = Component(AttributeSignal, '_acquire_time', kind=Kind.config)
     commStatus = Component(AttributeSignal, '_commStatus', kind=Kind.config)
     connected = Component(AttributeSignal, '_connected', kind=Kind.config)
-    filename = Component(RPCSignal, method="filename", kind=Kind.config)
-    calibration = Component(RPCSignal, method='calibration_state', kind=Kind.config)
+    # These only change when a file or scan starts or ends, which invalidates them,
+    # so they are cached. The ttl covers changes made by other clients
+    filename = Component(RPCSignal, method="filename", kind=Kind.config, use_cache=True, cache_ttl=10)
+    calibration = Component(RPCSignal, method='calibration_state', kind=Kind.config, use_cache=True,
+                            cache_ttl=10)
     state = Component(RPCSignal, method='state', kind=Kind.config)
-    scan_num = Component(RPCSignal, method='scan_num', kind=Kind.config)
-    scan_str = Component(RPCSignal, method='scan_str', kind=Kind.config)
+    scan_num = Component(RPCSignal, method='scan_num', kind=Kind.config, use_cache=True, cache_ttl=10)
+    scan_str = Component(RPCSignal, method='scan_str', kind=Kind.config, use_cache=True, cache_ttl=10)
+    # Stage timestamps of the latest finished point, see PointTimes. Set their kind to
+    # normal to record them in each event
+    trigger_time = Component(Signal, value=0.0, kind=Kind.omitted)
+    start_ack_time = Component(Signal, value=0.0, kind=Kind.omitted)
+    end_ack_time = Component(Signal, value=0.0, kind=Kind.omitted)
+    finished_time = Component(Signal, value=0.0, kind=Kind.omitted)
 
     def __init__(self, name, *args, verbose=False, path=None, **kwargs):
         super().__init__(*args, name=name, **kwargs)
@@ -40,7 +96,11 @@ class TESBase(Device, RPCInterface):
         self._completion_status = None
         self._save_roi = False
         self.verbose = verbose
+        self.acquisition_worker = AcquisitionWorker(name)
         self.file_mode = "continuous"  # Or "start_stop"
+        self.acquire_mode = "client"  # Or "server", to have the server time each point
+        self._roi_cache = ROICache(self.rpc)
+        self.point_times = PointTimes()
         self.write_ljh = True
         self.write_off = True
         self.rois = {"tfy": (0, 1200)}
@@ -73,13 +133,20 @@ class TESBase(Device, RPCInterface):
             path = self.path
         if self.state.get() == "no_file" or force:
             msg = self.rpc.file_start(path, write_ljh=self.write_ljh, write_off=self.write_off, setFilenamePattern=self.setFilenamePattern)
+            self._invalidate_rpc_signals()
             return msg
         else:
             print("TES already has file open, not forcing!")
             return {"success": True, "response": "File already open"}
 
     def _file_end(self):
-        return self.rpc.file_end()
+        msg = self.rpc.file_end()
+        self._invalidate_rpc_signals()
+        return msg
+
+    def _invalidate_rpc_signals(self):
+        for sig in rpc_signals_of(self):
+            sig.invalidate()
 
     def _calibration_start(self):
         if self.scanexfiltrator is not None:
@@ -95,6 +162,7 @@ class TESBase(Device, RPCInterface):
         routine = 'simulated_source'
         if self.verbose: print(f"start calibration scan {scan_num}")
         self.rpc.calibration_start(var_name, var_unit, scan_num, sample_id, sample_name, routine)
+        self._invalidate_rpc_signals()
 
     def _scan_start(self):
         if self.scanexfiltrator is not None:
@@ -108,10 +176,12 @@ class TESBase(Device, RPCInterface):
         start_energy = scaninfo.get("start_energy", -1)
         if self.verbose: print(f"start scan {scan_num}")
         msg = self.rpc.scan_start(var_name, var_unit, sample_id, sample_name, extra={"start_energy": start_energy})
+        self._invalidate_rpc_signals()
         
         
     def _scan_end(self):
         msg = self.rpc.scan_end(_try_post_processing=False)
+        self._invalidate_rpc_signals()
         self.scanexfiltrator = None
 
     def _acquire(self, status, i):
@@ -122,10 +192,20 @@ class TESBase(Device, RPCInterface):
         else:
             val = i
 
+        if self.acquire_mode == "server":
+            msg = self.rpc.scan_point_acquire(self.acquire_time.get(), val)
+            if not msg['success']:
+                raise RPCException(f"RPC failed with message {msg['response']}")
+            self.point_times.mark(i, "end_ack")
+            self.last_time = float(msg['response']['start'])
+            status.set_finished()
+            return
         last_time = self.rpc.scan_point_start(val)['response']
+        self.point_times.mark(i, "start_ack")
         self.last_time = float(last_time)
         ttime.sleep(self.acquire_time.get())
         self.rpc.scan_point_end()
+        self.point_times.mark(i, "end_ack")
         #self.last_time = ttime.time()
         status.set_finished()
         return
@@ -136,6 +216,7 @@ class TESBase(Device, RPCInterface):
         if path is None:
             path = self.path
         self.rpc.file_start(path, write_ljh=True, write_off=False, setFilenamePattern=self.setFilenamePattern)
+        self._invalidate_rpc_signals()
         ttime.sleep(time)
         msg = self._file_end()
         self.rpc.set_pulse_triggers()
@@ -147,6 +228,7 @@ class TESBase(Device, RPCInterface):
         if path is None:
             path = self.path
         self.rpc.file_start(path, write_ljh=True, write_off=False, setFilenamePattern=self.setFilenamePattern)
+        self._invalidate_rpc_signals()
         ttime.sleep(time)
         msg = self._file_end()
         return msg
@@ -173,18 +255,46 @@ class TESBase(Device, RPCInterface):
                           "llim": self.rois[k][0], "ulim": self.rois[k][1]}
         return d
 
+    def read_configuration(self):
+        with prefetch_rpc_signals(rpc_signals_of(self)):
+            return super().read_configuration()
+
+    def describe_configuration(self):
+        with prefetch_rpc_signals(rpc_signals_of(self)):
+            return super().describe_configuration()
+
     @property
     def hints(self):
         return self._hints
 
+    def stage(self):
+        # Each scan's timing summary covers only its own points
+        self.point_times.reset()
+        return super().stage()
+
     def trigger(self):
         if self.verbose:
             print("Triggering TES")
         status = DeviceStatus(self)
         i = next(self._data_index)
-        threading.Thread(target=self._acquire, args=(status, i), daemon=True).start()
+        self.point_times.mark(i, "trigger")
+        status.add_callback(lambda st: self._point_finished(i))
+        self.acquisition_worker.submit(self._acquire, status, i)
         return status
 
+    def _point_finished(self, i):
+        self.point_times.mark(i, "finished")
+        times = self.point_times.get(i)
+        for stage in ("trigger", "start_ack", "end_ack", "finished"):
+            getattr(self, f"{stage}_time").put(times.get(stage, float("nan")))
+
+    def timing_summary(self):
+        """
+        How the points of the current or last scan divide into overhead and acquisition,
+        see PointTimes.summary
+        """
+        return self.point_times.summary()
+
     def stop(self):
         if self._completion_status is not None:
             self._completion_status.set_finished()
@@ -1,35 +1,121 @@
 from ophyd.signal import Signal
 from ophyd.utils.epics_pvs import data_type, data_shape
+from ophyd.utils import ReadOnlyError
 from .rpc import RPCInterface
+from contextlib import contextmanager
 import time as ttime
 
+_NOT_CACHED = object()
+
 class RPCSignalPair(Signal, RPCInterface):
-    def __init__(self, *args, get_method, set_method, get_args=[], set_args=[],**kwargs):
+    def __init__(self, *args, get_method, set_method, get_args=[], set_args=[], use_cache=False,
+                 cache_ttl=None, **kwargs):
         """
         A signal to define an RPC get/set pair
+
+        use_cache: if True, get() answers with the last value fetched or put, as long
+            as it is fresh, instead of calling the server
+        cache_ttl: seconds a cached value stays fresh, None to keep it until invalidate()
         """
         super().__init__(*args, **kwargs)
         self.rpc_get = get_method
         self.rpc_set = set_method
         self.get_args = get_args
         self.set_args = set_args
-        
-    def get(self, **kwargs):
+        self.use_cache = use_cache
+        self.cache_ttl = cache_ttl
+        self._cached = _NOT_CACHED
+        self._cached_at = 0
+        self._prefetched = False
+
+    def _store(self, value):
+        self._cached = value
+        self._cached_at = ttime.monotonic()
+
+    def _store_result(self, r):
+        """
+        Cache the value of a successful get. A failed get's response is an error
+        message, not a value, so it clears the cache instead
+        """
+        if r['success']:
+            self._store(r['response'])
+        else:
+            self.invalidate()
+
+    def cache_fresh(self):
+        if self._cached is _NOT_CACHED:
+            return False
+        return self.cache_ttl is None or ttime.monotonic() - self._cached_at < self.cache_ttl
+
+    def invalidate(self):
+        """
+        Forget the cached value, so the next get() asks the server
+        """
+        self._cached = _NOT_CACHED
+
+    def _after_put(self, value, r):
+        if r['success'] and self.rpc_set == self.rpc_get:
+            self._store(value)
+        else:
+            # The put may have changed what the server returns in some other way
+            self.invalidate()
+
+    def get(self, use_cache=None, **kwargs):
+        if use_cache is None:
+            use_cache = self.use_cache or self._prefetched
+        if use_cache and self.cache_fresh():
+            return self._cached
         r = self.rpc.sendrcv(self.rpc_get, *self.get_args)
         response = r['response']
         success = r['success']
+        self._store_result(r)
         return response
 
     def put(self, value, **kwargs):
         if not self.write_access:
             raise ReadOnlyError("RPCSignal is marked as read-only")
-        old_value = self.get()
-        _ = self.rpc.sendrcv(self.rpc_set, value, *self.set_args)
+        if self.use_cache and self._cached is not _NOT_CACHED:
+            old_value = self._cached
+        else:
+            old_value = self.get()
+        r = self.rpc.sendrcv(self.rpc_set, value, *self.set_args)
+        self._after_put(value, r)
+        self._run_subs(sub_type=self.SUB_VALUE, old_value=old_value,
+                       value=value, timestamp=ttime.time())
+
+    async def get_async(self, use_cache=None, **kwargs):
+        """
+        Awaitable get, made through the RPC client's asyncio counterpart
+        """
+        if use_cache is None:
+            use_cache = self.use_cache
+        if use_cache and self.cache_fresh():
+            return self._cached
+        r = await self.rpc.asyncio_client().sendrcv(self.rpc_get, *self.get_args)
+        self._store_result(r)
+        return r['response']
+
+    async def put_async(self, value, **kwargs):
+        """
+        Awaitable put, made through the RPC client's asyncio counterpart
+        """
+        if not self.write_access:
+            raise ReadOnlyError("RPCSignal is marked as read-only")
+        if self.use_cache and self._cached is not _NOT_CACHED:
+            old_value = self._cached
+        else:
+            old_value = await self.get_async()
+        r = await self.rpc.asyncio_client().sendrcv(self.rpc_set, value, *self.set_args)
+        self._after_put(value, r)
         self._run_subs(sub_type=self.SUB_VALUE, old_value=old_value,
                        value=value, timestamp=ttime.time())
 
     def describe(self):
-        value = self.get()
+        # dtype and shape do not change with the value, so any cached value will do
+        if self._cached is not _NOT_CACHED:
+            value = self._cached
+        else:
+            value = self.get()
         desc = {'source': '{}/{}'.format(self.describe_rpc(), self.rpc_get),
                 'dtype': data_type(value),
                 'shape': data_shape(value),
@@ -37,6 +123,32 @@ class RPCSignalPair(Signal, RPCInterface):
                 'set_args': self.set_args}
         return {self.name: desc}
 
+@contextmanager
+def prefetch_rpc_signals(signals):
+    """
+    Fetch the values of several RPC signals in one round trip per client, and have
+    their get() answer with those values until the context exits. Signals using
+    their cache that hold a fresh value are not fetched again
+    """
+    by_client = {}
+    for sig in signals:
+        if not (sig.use_cache and sig.cache_fresh()):
+            by_client.setdefault(id(sig.rpc), []).append(sig)
+    try:
+        for sigs in by_client.values():
+            responses = sigs[0].rpc.call_many([(sig.rpc_get, sig.get_args) for sig in sigs])
+            for sig, r in zip(sigs, responses):
+                sig._store_result(r)
+                # A signal whose fetch failed asks the server again, and reports the error
+                sig._prefetched = r['success']
+        yield
+    finally:
+        for sig in signals:
+            sig._prefetched = False
+
+def rpc_signals_of(device):
+    return [walk.item for walk in device.walk_signals() if isinstance(walk.item, RPCSignalPair)]
+
 class RPCSignalPairAuto(RPCSignalPair):
     """
     Convenience class for the common case where the 'get' and 'set' method names share a
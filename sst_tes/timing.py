@@ -0,0 +1,131 @@
+import threading
+import time as ttime
+from collections import deque, OrderedDict
+import numpy as np
+
+
+class LatencyStats:
+    """
+    Durations of the phases of each call (e.g. connect, send, wait, decode), kept per
+    method for its last `history` calls. Recording costs a deque append, so it can stay
+    on in the hot path.
+
+    If log_interval is set, a summary is printed from record() at most once every
+    log_interval seconds
+    """
+    def __init__(self, name="rpc", history=1000, log_interval=None):
+        self.name = name
+        self.history = history
+        self.log_interval = log_interval
+        self._samples = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._last_log = ttime.monotonic()
+
+    def record(self, method, **phases):
+        """
+        Record one call of method, with the seconds spent in each phase
+        """
+        with self._lock:
+            if method not in self._samples:
+                self._samples[method] = deque(maxlen=self.history)
+                self._calls[method] = 0
+            self._samples[method].append(phases)
+            self._calls[method] += 1
+        if self.log_interval is not None and ttime.monotonic() - self._last_log >= self.log_interval:
+            self._last_log = ttime.monotonic()
+            print(self.summary())
+
+    def stats(self):
+        """
+        {method: {"calls": total calls, phase: {"mean", "p50", "p95", "max"}, ...}}, with
+        phase times in seconds over the calls still in the history
+        """
+        with self._lock:
+            samples = {method: list(s) for method, s in self._samples.items()}
+            calls = dict(self._calls)
+        result = {}
+        for method, s in samples.items():
+            result[method] = {"calls": calls[method]}
+            for phase in s[0]:
+                t = np.array([sample.get(phase, 0.0) for sample in s])
+                result[method][phase] = {"mean": float(t.mean()),
+                                         "p50": float(np.percentile(t, 50)),
+                                         "p95": float(np.percentile(t, 95)),
+                                         "max": float(t.max())}
+        return result
+
+    def summary(self):
+        """
+        One line per method with the mean and 95th percentile of each phase, in ms
+        """
+        lines = [f"{self.name} latency (mean/p95 ms):"]
+        for method, s in sorted(self.stats().items()):
+            phases = " ".join(f"{phase}={t['mean']*1e3:.2f}/{t['p95']*1e3:.2f}"
+                              for phase, t in s.items() if phase != "calls")
+            lines.append(f"  {method} x{s['calls']}: {phases}")
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+            self._calls = {}
+
+
+class PointTimes:
+    """
+    Wall-clock timestamps of the stages of each point of a scan, by point index:
+    trigger received, point start acknowledged by the server, point end acknowledged,
+    status finished, and ROIs read. summary() breaks the points down into the
+    intervals between stages, to show how much of each point is overhead. Only the
+    last `history` points are kept
+    """
+    stages = ("trigger", "start_ack", "end_ack", "finished", "roi_read")
+    intervals = {"start": ("trigger", "start_ack"),
+                 "acquire": ("start_ack", "end_ack"),
+                 # The server times the point itself in TESBase's "server" acquire_mode,
+                 # and does not acknowledge the start
+                 "trigger_to_end": ("trigger", "end_ack"),
+                 "finish": ("end_ack", "finished"),
+                 "read": ("finished", "roi_read"),
+                 "total": ("trigger", "roi_read")}
+
+    def __init__(self, history=10000):
+        self.history = history
+        self.points = OrderedDict()
+        self.last_index = None
+        self._lock = threading.Lock()
+
+    def mark(self, i, stage, t=None):
+        """
+        Record that point i reached stage, at time t or now
+        """
+        with self._lock:
+            self.points.setdefault(i, {})[stage] = ttime.time() if t is None else t
+            if len(self.points) > self.history:
+                self.points.popitem(last=False)
+            if stage == "trigger":
+                self.last_index = i
+
+    def get(self, i):
+        with self._lock:
+            return dict(self.points.get(i, {}))
+
+    def reset(self):
+        with self._lock:
+            self.points = OrderedDict()
+            self.last_index = None
+
+    def summary(self):
+        """
+        {"points": n, interval: {"mean", "max"}, ...} in seconds, each interval over the
+        points that reached both of its stages
+        """
+        with self._lock:
+            points = list(self.points.values())
+        result = {"points": len(points)}
+        for name, (first, last) in self.intervals.items():
+            t = np.array([p[last] - p[first] for p in points if first in p and last in p])
+            if len(t):
+                result[name] = {"mean": float(t.mean()), "max": float(t.max())}
+        return result
@@ -0,0 +1,260 @@
+"""
+Wire format helpers for the TES JSON RPC, shared by the client and the sim server.
+
+A framed message is a 4 byte big-endian payload length followed by the payload.
+Unframed messages are bare JSON documents, as sent by older clients and servers,
+and are read until the brackets of the top-level object balance.
+
+The payload of a framed message is JSON, or, if the client asked for it by sending
+"accept": ["npbuf"], may be the binary NPBUF encoding: BINARY_MAGIC, a 4 byte
+little-endian header length, and a JSON header {"doc": ..., "buffers": [...]},
+followed by the raw bytes of each NumPy array in the document. Arrays in "doc" are
+replaced by {"__ndarray__": i, "dtype": ..., "shape": [...]}, where i indexes the
+[offset, nbytes] pairs in "buffers", counted from the end of the header.
+"""
+import json
+import re
+import socket
+import struct
+import numpy as np
+
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 2**30
+RECV_CHUNK = 2**16
+MAX_UNFRAMED_SIZE = 2**26
+BINARY_MAGIC = b"\x00NPB"
+BINARY_HEADER = struct.Struct("<I")
+BINARY_ENCODING = "npbuf"
+BUFFER_ALIGN = 8
+
+
+def is_framed(first_byte):
+    """
+    Distinguish a framed message from a legacy one by its first byte. A frame header
+    for any frame below MAX_FRAME_SIZE starts with a byte below ord('{')
+    """
+    return first_byte[0] != ord("{")
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    sock.sendall(frame(payload))
+
+
+def recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), RECV_CHUNK))
+        if chunk == b'':
+            raise ConnectionError(f"Connection closed after {len(buf)} of {n} bytes")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    (n,) = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    if n > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {n} bytes exceeds the maximum of {MAX_FRAME_SIZE}")
+    return recv_exactly(sock, n)
+
+
+class _DocumentScanner:
+    """
+    Tracks how far an unframed JSON object or array has got, across reads, by
+    counting brackets outside of strings. Each byte is looked at once, so a document
+    split over many reads costs no more than one that arrives whole
+    """
+    _tokens = re.compile(rb'["\\\[\]{}]')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.size = 0
+
+    def feed(self, chunk):
+        """
+        Add the next bytes, returning True once the document is complete. A document
+        that does not start with { or [ is taken to be complete as it stands
+        """
+        self.size += len(chunk)
+        if self.size > MAX_UNFRAMED_SIZE:
+            raise ValueError(f"Unframed message exceeds the maximum of {MAX_UNFRAMED_SIZE} bytes")
+        if not self.started:
+            stripped = chunk.lstrip()
+            if not stripped:
+                return False
+            self.started = True
+            if stripped[:1] not in (b'{', b'['):
+                return True
+        pos = 0
+        for m in self._tokens.finditer(chunk):
+            token = m.group()
+            if self.escaped:
+                self.escaped = False
+                if m.start() == pos:
+                    pos = m.end()
+                    continue
+            pos = m.end()
+            if self.in_string:
+                if token == b'\\':
+                    self.escaped = True
+                elif token == b'"':
+                    self.in_string = False
+            elif token == b'"':
+                self.in_string = True
+            elif token in (b'{', b'['):
+                self.depth += 1
+            elif token in (b'}', b']'):
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        if self.escaped and pos != len(chunk):
+            # The escaped character was not a token, and is behind us
+            self.escaped = False
+        return False
+
+
+def recv_unframed(sock, stall_timeout=None):
+    """
+    Read a bare JSON document, however many reads it takes to arrive. Reading stops
+    as soon as the brackets balance, and the bytes are returned whether or not they
+    parse, so a malformed message gets a parse error rather than a hang.
+
+    stall_timeout: seconds to wait for more of a document that has stopped arriving
+    before giving up and returning what there is, which will not parse. Without it, a
+    truncated document waits for the socket's own timeout
+    """
+    scanner = _DocumentScanner()
+    chunks = []
+    old_timeout = sock.gettimeout()
+    if stall_timeout is not None:
+        sock.settimeout(stall_timeout)
+    try:
+        while True:
+            try:
+                chunk = sock.recv(RECV_CHUNK)
+            except socket.timeout:
+                if stall_timeout is None or not chunks:
+                    raise
+                break
+            if chunk == b'':
+                raise ConnectionError(f"Connection closed after {scanner.size} bytes of an incomplete message")
+            chunks.append(chunk)
+            if scanner.feed(chunk):
+                break
+    finally:
+        if stall_timeout is not None:
+            sock.settimeout(old_timeout)
+    return b''.join(chunks)
+
+
+async def read_frame(reader):
+    """
+    asyncio counterpart of recv_frame, for an asyncio.StreamReader
+    """
+    (n,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if n > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {n} bytes exceeds the maximum of {MAX_FRAME_SIZE}")
+    return await reader.readexactly(n)
+
+
+async def read_unframed(reader):
+    """
+    asyncio counterpart of recv_unframed, for an asyncio.StreamReader
+    """
+    scanner = _DocumentScanner()
+    chunks = []
+    while True:
+        chunk = await reader.read(RECV_CHUNK)
+        if chunk == b'':
+            raise ConnectionError(f"Connection closed after {scanner.size} bytes of an incomplete message")
+        chunks.append(chunk)
+        if scanner.feed(chunk):
+            return b''.join(chunks)
+
+
+def json_default(obj):
+    """
+    json.dumps default for NumPy values, which are sent as plain lists and numbers
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def has_arrays(obj):
+    if isinstance(obj, np.ndarray):
+        return True
+    if isinstance(obj, dict):
+        return any(has_arrays(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(has_arrays(v) for v in obj)
+    return False
+
+
+def encode_binary(doc):
+    """
+    Encode a document holding NumPy arrays as an NPBUF payload
+    """
+    arrays = []
+
+    def strip(obj):
+        if isinstance(obj, np.ndarray):
+            arrays.append(np.ascontiguousarray(obj))
+            return {"__ndarray__": len(arrays) - 1, "dtype": obj.dtype.str, "shape": list(obj.shape)}
+        if isinstance(obj, dict):
+            return {k: strip(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [strip(v) for v in obj]
+        return obj
+
+    stripped = strip(doc)
+    buffers = []
+    offset = 0
+    for a in arrays:
+        offset = -(-offset // BUFFER_ALIGN) * BUFFER_ALIGN
+        buffers.append([offset, a.nbytes])
+        offset += a.nbytes
+    header = json.dumps({"doc": stripped, "buffers": buffers}, default=json_default).encode()
+    # Pad the header so that the buffers start aligned too
+    start = len(BINARY_MAGIC) + BINARY_HEADER.size + len(header)
+    header += b" " * (-start % BUFFER_ALIGN)
+    body = bytearray(offset)
+    for a, (o, n) in zip(arrays, buffers):
+        body[o:o + n] = a.tobytes()
+    return BINARY_MAGIC + BINARY_HEADER.pack(len(header)) + header + bytes(body)
+
+
+def decode_payload(data):
+    """
+    Decode a JSON or NPBUF payload. Arrays are read-only views into data
+    """
+    if not data.startswith(BINARY_MAGIC):
+        return json.loads(data.decode())
+    start = len(BINARY_MAGIC) + BINARY_HEADER.size
+    (n,) = BINARY_HEADER.unpack(data[len(BINARY_MAGIC):start])
+    header = json.loads(data[start:start + n].decode())
+    body = start + n
+    buffers = header["buffers"]
+
+    def restore(obj):
+        if isinstance(obj, dict):
+            if "__ndarray__" in obj:
+                offset, nbytes = buffers[obj["__ndarray__"]]
+                dtype = np.dtype(obj["dtype"])
+                a = np.frombuffer(data, dtype=dtype, count=nbytes // dtype.itemsize,
+                                  offset=body + offset)
+                return a.reshape(obj["shape"])
+            return {k: restore(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [restore(v) for v in obj]
+        return obj
+
+    return restore(header["doc"])